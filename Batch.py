@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+
+from random import Random
+from Cache import default_cache
+from Render import RenderPool
+from time import perf_counter
+
+# Renders in the batch workers stay in the worker instead of fanning out again.
+_worker_pool = None
+
+
+def seed_names(argv):
+    """
+    Collects the names to render from the command line. Each name seeds its
+    image just as -name does, and names the PNG it is saved to.
+        -seeds a b c        The names listed, up to the next option.
+        -seed_range m n     The numbers m up to but not including n.
+        -manifest file      One name per line; blank lines and # comments are skipped.
+    :param argv: The command line arguments.
+    :return: The list of names, empty if none of the options are given.
+    """
+    names = []
+    if "-seeds" in argv:
+        for arg in argv[argv.index("-seeds") + 1:]:
+            if arg.startswith("-"):
+                break
+            names.append(arg)
+    if "-seed_range" in argv:
+        index = argv.index("-seed_range")
+        names.extend(str(i) for i in range(int(argv[index + 1]), int(argv[index + 2])))
+    if "-manifest" in argv:
+        with open(argv[argv.index("-manifest") + 1]) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    names.append(line)
+    return names
+
+
+def render_batch(save, width, height, names, *args, processes=None):
+    """
+    Renders one image per name in a pool of worker processes, so start-up is
+    paid once for the whole batch.
+    :param save: The save function, as save_RGB, called as
+                 save(width, height, name, *args, rng=Random(name), pool=pool).
+    :param width: The width of the images, in pixels.
+    :param height: The height of the images, in pixels.
+    :param names: The names of the images, which also seed them.
+    :param args: Any further arguments for save, as fuzzy for save_palette.
+    :param processes: The number of worker processes, by default one per
+                      available core. With one, the images are rendered here.
+    :return: A generator of the names of the images, as each is saved.
+    """
+    if processes is None:
+        processes = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    tasks = [(save, width, height, name, args) for name in names]
+    if processes <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _render_one(task, None)
+        return
+    with multiprocessing.Pool(min(processes, len(tasks))) as pool:
+        yield from pool.imap_unordered(_render_worker, tasks)
+
+
+def run_batch(save, width, height, names, *args, processes=None):
+    """
+    Renders a batch with render_batch, printing each PNG as it is saved and
+    then the rate.
+    :return: The number of images per second.
+    """
+    start = perf_counter()
+    for name in render_batch(save, width, height, names, *args, processes=processes):
+        print(name + ".png", flush=True)
+    rate = len(names) / (perf_counter() - start)
+    print("{} images in {:.2f}s, {:.2f} images/s".format(len(names), len(names) / rate, rate))
+    return rate
+
+
+def _render_one(task, pool):
+    save, width, height, name, args = task
+    save(width, height, name, *args, rng=Random(name), pool=pool)
+    return name
+
+
+def _render_worker(task):
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = RenderPool(1, cache=default_cache())
+    return _render_one(task, _worker_pool)
@@ -0,0 +1,241 @@
+import Functions
+import json
+import numpy as np
+import os
+import platform
+import scipy
+
+from Functions import *
+from Render import *
+from datetime import datetime
+from datetime import timezone
+from random import Random
+from random import seed
+from sys import argv
+from time import perf_counter
+
+
+def legacy_calibrate(self, resolution=None):
+    """The original per-point calibration loop, kept to measure against."""
+    self.zmin = self.eval(1, 1, False)
+    self.zmax = self.zmin
+    for ix in range(-100, 100):
+        for iy in range(-100, 100):
+            z = self.eval(ix / 100, iy / 100, False)
+            self.zmin = min(self.zmin, z)
+            self.zmax = max(self.zmax, z)
+
+
+def trees_per_second(complexity, count):
+    start = perf_counter()
+    for i in range(count):
+        FunctionNode(complexity)
+    return count / (perf_counter() - start)
+
+
+def benchmark_calibration(complexity=0.6, count=20):
+    """
+    Measures how many trees per second can be built with the legacy scalar
+    calibration, the current calibration (analytic bounds, falling back to
+    vectorized sampling), and the current calibration when every sampled
+    function is already in the cache (as when rebuilding trees).
+    :param complexity: The probability passed to FunctionNode.
+    :param count: The number of trees built for each measurement.
+    :return: A dict of trees per second for each calibration mode.
+    """
+    calibrate = Function.calibrate
+    results = {}
+    try:
+        Function.calibrate = legacy_calibrate
+        seed("benchmark")
+        results["legacy"] = trees_per_second(complexity, count)
+    finally:
+        Function.calibrate = calibrate
+    Functions._calibration_cache.clear()
+    seed("benchmark")
+    results["vectorized"] = trees_per_second(complexity, count)
+    seed("benchmark")
+    results["cached"] = trees_per_second(complexity, count)
+    return results
+
+
+def rate(func, count):
+    """
+    Calls func count times.
+    :return: The number of calls per second.
+    """
+    start = perf_counter()
+    for i in range(count):
+        func()
+    return count / (perf_counter() - start)
+
+
+def benchmark_primitive(primitive, count=1000, size=200):
+    """
+    Measures one primitive on its own.
+    :param primitive: The Function subclass to measure.
+    :param count: The number of constructions and of scalar evaluations.
+    :param size: The width and height of the grid for grid evaluations.
+    :return: A dict of constructions per second, and scalar and grid
+             evaluations (points) per second.
+    """
+    rng = Random(primitive.__name__)
+    func = primitive(rng=rng)
+    points = [(rng.random() * 2 - 1, rng.random() * 2 - 1) for i in range(count)]
+    start = perf_counter()
+    for x, y in points:
+        func.eval(x, y)
+    scalar = count / (perf_counter() - start)
+    xs, ys = np.broadcast_arrays(*pixel_grid(size, size))
+    repeats = max(1, count // 100)
+    with np.errstate(all='ignore'):
+        grid = size * size * rate(lambda: func.eval_grid(xs, ys), repeats)
+    return {
+        "constructions_per_second": rate(lambda: primitive(rng=rng), count),
+        "scalar_evals_per_second": scalar,
+        "grid_evals_per_second": grid
+    }
+
+
+def full_tree(depth, rng):
+    """
+    Builds a tree with every branch depth functions deep, unlike
+    FunctionNode which stops branches at random.
+    :param depth: The number of functions from the root to each leaf.
+    :param rng: The random.Random the functions are drawn from.
+    :return: The FunctionNode.
+    """
+    if depth == 0:
+        return None
+    func = FunctionNode(0, rng=rng).func
+    left = full_tree(depth - 1, rng) or X()
+    right = full_tree(depth - 1, rng) or Y()
+    return FunctionNode.from_parts(func, left, right)
+
+
+def benchmark_tree(depth, count=20, size=200):
+    """
+    Measures whole trees of one depth, averaged over count different trees.
+    :param depth: The depth of the trees, see full_tree.
+    :param count: The number of trees.
+    :param size: The width and height of the grid for grid evaluations.
+    :return: A dict of trees built per second, and scalar and grid
+             evaluations (points) per second.
+    """
+    rng = Random("depth {}".format(depth))
+    start = perf_counter()
+    trees = [full_tree(depth, rng) for i in range(count)]
+    constructions = count / (perf_counter() - start)
+    points = [(rng.random() * 2 - 1, rng.random() * 2 - 1) for i in range(100)]
+    start = perf_counter()
+    for tree in trees:
+        for x, y in points:
+            tree.eval(x, y)
+    scalar = count * len(points) / (perf_counter() - start)
+    xs, ys = pixel_grid(size, size)
+    start = perf_counter()
+    for tree in trees:
+        tree.eval_grid(xs, ys)
+    grid = count * size * size / (perf_counter() - start)
+    return {
+        "nodes": 2 ** depth - 1,
+        "constructions_per_second": constructions,
+        "scalar_evals_per_second": scalar,
+        "grid_evals_per_second": grid
+    }
+
+
+class CountingPool(RenderPool):
+    """A RenderPool in this process that counts the points it evaluates."""
+    def __init__(self):
+        super().__init__(1)
+        self.points = 0
+
+    def render(self, trees, xs, ys, lut=False, cache=True):
+        self.points += np.broadcast(xs, ys).size * len(trees)
+        return super().render(trees, xs, ys, lut, cache)
+
+
+def benchmark_adaptive(tolerance=ADAPTIVE_TOLERANCE, count=12, width=1200, height=800):
+    """
+    Measures adaptive_values against evaluating every pixel, over the trees
+    an RGB image would use.
+    :param tolerance: The tolerance passed to adaptive_values.
+    :param count: The number of trees.
+    :param width: The width of the grid, in pixels.
+    :param height: The height of the grid, in pixels.
+    :return: A dict of the share of points evaluated, the seconds each way,
+             and the share of pixels more than one level off in a band with
+             a range of 256.
+    """
+    pool, counting_pool = RenderPool(1), CountingPool()
+    xs, ys = pixel_grid(width, height, (0, 2), (0, 2))
+    rng = Random("benchmark")
+    exact_time = adaptive_time = 0
+    off = 0
+    for i in range(count):
+        tree = FunctionNode(0.6, rng=rng)
+        start = perf_counter()
+        exact, = pool.render((tree,), xs, ys)
+        exact_time += perf_counter() - start
+        start = perf_counter()
+        values = adaptive_values(tree, xs, ys, tolerance, pool=counting_pool)
+        adaptive_time += perf_counter() - start
+        with np.errstate(invalid="ignore"):
+            off += np.count_nonzero(abs(values - exact) > 2 / 256)
+    return {
+        "evaluated": counting_pool.points / (count * width * height),
+        "exact_seconds": exact_time,
+        "adaptive_seconds": adaptive_time,
+        "off_by_a_level": off / (count * width * height)
+    }
+
+
+def run_benchmarks(count=1000, depths=(1, 2, 3, 4, 5)):
+    """
+    Runs every benchmark.
+    :param count: The number of repetitions for each primitive measurement.
+    :param depths: The tree depths to measure.
+    :return: A JSON-serializable dict of every result, with a "meta" dict of
+             the settings and versions they were measured with.
+    """
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "count": count,
+            "depths": list(depths)
+        },
+        "primitives": {primitive.__name__: benchmark_primitive(primitive, count)
+                       for primitive in PRIMITIVES if primitive not in (X, Y, Constant)},
+        "trees": {str(depth): benchmark_tree(depth) for depth in depths},
+        "calibration": benchmark_calibration()
+    }
+
+
+if __name__ == "__main__":
+    count = None
+    if "-count" in argv:
+        count = int(argv[argv.index("-count") + 1])
+    if "-calibration" in argv:
+        # The legacy calibration builds trees slowly, so this keeps its own
+        # small default count rather than the primitives' 1000.
+        rates = benchmark_calibration() if count is None else benchmark_calibration(count=count)
+        for mode, trees_rate in rates.items():
+            print("{:>10}: {:10.1f} trees/s".format(mode, trees_rate))
+    elif "-adaptive" in argv:
+        tolerance = ADAPTIVE_TOLERANCE
+        if "-tolerance" in argv:
+            tolerance = float(argv[argv.index("-tolerance") + 1])
+        print(json.dumps(benchmark_adaptive(tolerance), indent=2))
+    else:
+        results = json.dumps(run_benchmarks(count or 1000), indent=2)
+        if "-json" in argv:
+            with open(argv[argv.index("-json") + 1], "w") as f:
+                f.write(results)
+        else:
+            print(results)
@@ -0,0 +1,154 @@
+import hashlib
+import numpy as np
+import os
+import tempfile
+
+# Change this whenever the values a tree renders to change, to miss every old entry.
+CACHE_VERSION = 2
+# The most the cache keeps on disk by default, in bytes.
+CACHE_BYTES = 1 << 30
+
+
+class RenderCache:
+    """
+    Keeps rendered channel values on disk, addressed by a hash of everything
+    that decides them: the tree's binary genome (every node type, constant
+    and calibrated bound), the exact coordinates of the grid, which carry
+    both the coordinate mapping and the resolution, and whether the lookup
+    tables were used. A render that hits the cache loads the values instead
+    of evaluating the tree, and only the shifts, ranges or palette are
+    applied to them again.
+
+    Every entry is one .npy file. Hits refresh an entry's modification time,
+    and once the files pass max_bytes the least recently used are removed.
+    Entries are written to a temporary file and renamed into place, so
+    several processes can share a directory.
+    """
+    def __init__(self, directory, max_bytes=CACHE_BYTES):
+        """
+        :param directory: The directory to keep the values in, created if needed.
+        :param max_bytes: The most the entries may take up, in bytes.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, tree, xs, ys, lut=False):
+        """
+        The address of a tree's values over a grid.
+        :param tree: The FunctionNode.
+        :param xs: A row of x coordinates, as returned by pixel_grid.
+        :param ys: A column of y coordinates, as returned by pixel_grid.
+        :param lut: Whether the lookup tables are used.
+        :return: The hex digest.
+        """
+        # The shapes matter as well as the coordinates: eval_grid broadcasts a
+        # row against a column into a grid, but two rows pointwise.
+        header = "{} {} {} {} ".format(CACHE_VERSION, np.shape(xs), np.shape(ys), bool(lut))
+        digest = hashlib.sha256(header.encode())
+        digest.update(tree.to_bytes())
+        digest.update(np.ascontiguousarray(xs, "<f8").tobytes())
+        digest.update(np.ascontiguousarray(ys, "<f8").tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        :param key: The key, from RenderCache.key.
+        :return: The flat array of values, or None if they are not cached.
+        """
+        path = self._path(key)
+        try:
+            values = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return values.ravel()
+
+    def put(self, key, values):
+        """
+        Stores values under a key, evicting the least recently used entries
+        if the cache grows past max_bytes. Values bigger than the whole
+        cache are not stored.
+        :param key: The key, from RenderCache.key.
+        :param values: The array of values.
+        :return: None
+        """
+        values = np.asarray(values, np.float64)
+        if values.nbytes > self.max_bytes:
+            return
+        path = self._path(key)
+        handle, temp = tempfile.mkstemp(".tmp", dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.save(f, values)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(temp, path)
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(path) - replaced
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def size(self):
+        """The bytes taken up by every entry."""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Removes the least recently used entries until the rest fit.
+        :param max_bytes: The most the entries may take up, by default max_bytes.
+        :return: None
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        for path, entry_size, _ in entries:
+            if size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        self.evict(0)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+
+def default_cache():
+    """
+    The RenderCache the default pools use, kept in the directory named by
+    the RENDER_CACHE environment variable, and at most RENDER_CACHE_BYTES
+    bytes if that is set. Renders are not cached if RENDER_CACHE is not set.
+    :return: The RenderCache, or None.
+    """
+    directory = os.environ.get("RENDER_CACHE")
+    if not directory:
+        return None
+    return RenderCache(directory, int(os.environ.get("RENDER_CACHE_BYTES", CACHE_BYTES)))
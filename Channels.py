@@ -0,0 +1,264 @@
+import json
+import numpy as np
+import os
+
+from Functions import FunctionNode
+from Functions import make_rng
+from Functions import pixel_grid
+from PIL import Image as PILImage
+from Render import render_values
+from Render import value_band
+from Stream import PNGWriter
+from Stream import strips
+
+CHANNELS_VERSION = 1
+
+
+class ChannelImage:
+    """
+    The engine behind every image built from a set of Function Trees. Each
+    channel is a dict of its tree, the flat array of its values over the
+    grid, and the shift and range that quantize them, kept as an attribute
+    named for the channel. The engine owns the trees, the grid they are
+    evaluated over, the RenderPool that evaluates them, and quantizing the
+    values into an image, so the images themselves only configure it:
+        CHANNELS    A (name, shift bounds, range bounds) tuple for each channel,
+                    in order. The bounds are given to rng.randint.
+        COMPLEXITY  The complexity of new trees.
+        MODE        The PIL mode that image merges the channels in, or None
+                    if the channels are not an image on their own.
+    and override grid if the trees are not sampled once per pixel.
+    """
+    CHANNELS = ()
+    COMPLEXITY = 0.6
+    MODE = None
+
+    def __init__(self, width, height, rng=None, lut=False, pool=None, render=True, tolerance=None):
+        """
+        :param width: The width of the image, in pixels.
+        :param height: The height of the image, in pixels.
+        :param rng: The random.Random or NumPy Generator used to build the
+                    trees, by default the module-level generator that
+                    random.seed controls.
+        :param lut: Whether to evaluate the trees with the lookup tables.
+        :param pool: The RenderPool that renders the trees, by default the shared one.
+        :param render: Whether to render the values now, rather than leaving them to generate.
+        :param tolerance: If given, the trees are sampled adaptively with
+                          this tolerance, see Render.adaptive_values, instead
+                          of being evaluated at every point.
+        """
+        self.rng = make_rng(rng)
+        self.width = width
+        self.height = height
+        self.lut = lut
+        self.pool = pool
+        self.tolerance = tolerance
+        for name, shift, stretch in self.CHANNELS:
+            setattr(self, name, {
+                "tree": FunctionNode(self.COMPLEXITY, rng=self.rng),
+                "values": [],
+                "shift": self.rng.randint(*shift),
+                "range": self.rng.randint(*stretch)
+            })
+        if render:
+            self.generate()
+
+    def channels(self):
+        """The dict of every channel by name, in order."""
+        return {name: getattr(self, name) for name, _, _ in self.CHANNELS}
+
+    def grid(self, x_range=(-1, 1), y_range=(-1, 1)):
+        """
+        The points the trees are evaluated at, one for each pixel by default.
+        :param x_range: The x coordinates the image covers.
+        :param y_range: The y coordinates the image covers.
+        :return: A row of x coordinates and a column of y coordinates.
+        """
+        return pixel_grid(self.width, self.height, x_range, y_range)
+
+    def generate(self, x_range=(-1, 1), y_range=(-1, 1)):
+        """
+        Renders the values of every channel.
+        :param x_range: The x coordinates the image covers.
+        :param y_range: The y coordinates the image covers.
+        :return: None
+        """
+        channels = list(self.channels().values())
+        values = self._render(*[channel["tree"] for channel in channels], x_range=x_range, y_range=y_range)
+        for channel, channel_values in zip(channels, values):
+            channel["values"] = channel_values
+
+    def generate_channel(self, name):
+        """Renders the values of one channel, after its tree has changed."""
+        channel = getattr(self, name)
+        channel["values"], = self._render(channel["tree"])
+
+    def _render(self, *trees, x_range=(-1, 1), y_range=(-1, 1)):
+        xs, ys = self.grid(x_range, y_range)
+        return render_values(trees, xs, ys, self.lut, self.pool, self.tolerance)
+
+    def new_tree(self, complexity=None):
+        """A new tree from rng, of the given complexity or else COMPLEXITY."""
+        return FunctionNode(self.COMPLEXITY if complexity is None else complexity, rng=self.rng)
+
+    def new_channel(self, name, complexity=None):
+        """
+        Gives a channel a new tree and renders it.
+        :param name: The name of the channel.
+        :param complexity: The complexity of the tree, by default COMPLEXITY.
+        :return: None
+        """
+        getattr(self, name)["tree"] = self.new_tree(complexity)
+        self.generate_channel(name)
+
+    def new(self, complexity=None):
+        """
+        Gives every channel a new tree and renders them.
+        :param complexity: The complexity of each tree, by default COMPLEXITY for all.
+        :return: None
+        """
+        if complexity is None:
+            complexity = (self.COMPLEXITY,) * len(self.CHANNELS)
+        for channel, tree_complexity in zip(self.channels().values(), complexity):
+            channel["tree"] = self.new_tree(tree_complexity)
+        self.generate()
+
+    def image(self):
+        """Makes the RGB image of the values, with the current shifts and ranges."""
+        return self._merge([channel["values"] for channel in self.channels().values()], self.height)
+
+    def stream(self, file_name, x_range=(-1, 1), y_range=(-1, 1), values_name=None, strip_rows=None):
+        """
+        Renders the image and writes it to a PNG a strip of rows at a time,
+        so memory stays proportional to one strip for any size. The values
+        are not kept.
+        :param file_name: The name of the PNG.
+        :param x_range: The x coordinates the image covers.
+        :param y_range: The y coordinates the image covers.
+        :param values_name: The name of a .npy file to also write the raw
+                            values to, a strip at a time, if any.
+        :param strip_rows: The rows in each strip, see Stream.strips.
+        :return: None
+        """
+        channels = self.channels()
+        trees = [channel["tree"] for channel in channels.values()]
+        xs, ys = self.grid(x_range, y_range)
+        raw = channel_file(values_name, len(trees), self.width, self.height) if values_name else None
+        with PNGWriter(file_name, self.width, self.height) as png:
+            for start, stop in strips(self.width, self.height, strip_rows):
+                strip = render_values(trees, xs, ys[start:stop], self.lut, self.pool, self.tolerance)
+                png.write(self._merge(strip, stop - start))
+                if raw is not None:
+                    raw[:, start:stop] = np.reshape(strip, (len(trees), stop - start, self.width))
+        if raw is not None:
+            raw.flush()
+            save_channel_metadata(values_name, channels, self.width, self.height, lut=self.lut,
+                                  x_range=x_range, y_range=y_range)
+
+    def _merge(self, values, height):
+        if self.MODE is None:
+            raise TypeError("The channels of a {} are not an image".format(type(self).__name__))
+        bands = [value_band(channel_values, self.width, height, channel["shift"], channel["range"])
+                 for channel_values, channel in zip(values, self.channels().values())]
+        return PILImage.merge(self.MODE, bands).convert("RGB")
+
+    def save_values(self, file_name, **attributes):
+        """Saves the raw values of the channels to a .npy file, see save_channels."""
+        save_channels(file_name, self.channels(), self.width, self.height, lut=self.lut, **attributes)
+
+    @classmethod
+    def load_values(cls, file_name, rng=None, pool=None):
+        """
+        Rebuilds an image from save_values without evaluating its trees. The
+        values are memory-mapped, so they are only read as they are used.
+        :param file_name: The name of the .npy file.
+        :param rng: The generator for any new trees.
+        :param pool: The RenderPool that renders any new trees.
+        :return: The image.
+        """
+        metadata, channels = load_channels(file_name)
+        image = cls.__new__(cls)
+        image.rng = make_rng(rng)
+        image.width, image.height = metadata["width"], metadata["height"]
+        image.lut = metadata["lut"]
+        image.pool = pool
+        image.tolerance = None
+        for name, _, _ in cls.CHANNELS:
+            setattr(image, name, channels[name])
+        return image
+
+
+def metadata_name(file_name):
+    """The name of the JSON file describing the channels in a .npy file."""
+    return os.path.splitext(file_name)[0] + ".channels.json"
+
+
+def channel_file(file_name, count, width, height):
+    """
+    Creates a .npy file for the values of count channels, as one float64
+    array of count x height x width.
+    :return: The array, memory-mapped for writing.
+    """
+    return np.lib.format.open_memmap(file_name, mode="w+", dtype=np.float64, shape=(count, height, width))
+
+
+def save_channels(file_name, channels, width, height, **attributes):
+    """
+    Saves the raw values of an image's channels, so they can be regraded or
+    reused without evaluating the trees again. The values go to file_name,
+    see channel_file, and everything else about the channels to a JSON file
+    beside it, see save_channel_metadata.
+    :param file_name: The name of the .npy file.
+    :param channels: A dict of channel dicts by name, each with a tree and
+                     its width * height values.
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :param attributes: Anything else to record, as JSON-serializable values.
+    :return: None
+    """
+    values = channel_file(file_name, len(channels), width, height)
+    for i, channel in enumerate(channels.values()):
+        values[i] = np.reshape(channel["values"], (height, width))
+    values.flush()
+    del values
+    save_channel_metadata(file_name, channels, width, height, **attributes)
+
+
+def save_channel_metadata(file_name, channels, width, height, **attributes):
+    """
+    Writes the JSON file for the channels saved in file_name: the size,
+    every channel's tree as a genome with the rest of its dict (shift,
+    range and so on, but not its values), and any other attributes.
+    """
+    metadata = dict(attributes, version=CHANNELS_VERSION, width=width, height=height, channels=[])
+    for name, channel in channels.items():
+        entry = {key: value for key, value in channel.items() if key not in ("tree", "values")}
+        entry.update(name=name, tree=channel["tree"].to_genome())
+        metadata["channels"].append(entry)
+    with open(metadata_name(file_name), "w") as f:
+        json.dump(metadata, f)
+
+
+def load_channels(file_name, mmap=True):
+    """
+    Loads channels saved with save_channels. With mmap the values are
+    memory-mapped read-only, so nothing is read until it is used.
+    :param file_name: The name of the .npy file.
+    :param mmap: Whether to memory-map the values instead of reading them.
+    :return: The metadata dict, and a dict of channel dicts by name, with
+             their trees rebuilt and their flat values.
+    """
+    with open(metadata_name(file_name)) as f:
+        metadata = json.load(f)
+    if metadata.get("version") != CHANNELS_VERSION:
+        raise ValueError("Unsupported channels version: {}".format(metadata.get("version")))
+    values = np.load(file_name, mmap_mode="r" if mmap else None)
+    if values.shape != (len(metadata["channels"]), metadata["height"], metadata["width"]):
+        raise ValueError("{} does not match its metadata".format(file_name))
+    channels = {}
+    for i, entry in enumerate(metadata.pop("channels")):
+        channel = dict(entry)
+        channel["tree"] = FunctionNode.from_genome(channel["tree"])
+        channel["values"] = values[i].reshape(-1)
+        channels[channel.pop("name")] = channel
+    return metadata, channels
@@ -1,61 +1,234 @@
+import json
+import numpy as np
+import struct
+
 from random import choice
 from random import random
+from random import Random
 from math import *
+from scipy import optimize
 from scipy import special
 
 
+class NumpyRandom:
+    '''Gives a NumPy Generator the random, choice and randint methods of
+    random.Random that the generators use.'''
+    def __init__(self, generator):
+        self.generator = generator
+
+    def random(self):
+        return float(self.generator.random())
+
+    def choice(self, seq):
+        return seq[int(self.generator.integers(len(seq)))]
+
+    def randint(self, a, b):
+        return int(self.generator.integers(a, b + 1))
+
+
+def make_rng(rng=None):
+    '''Returns an object with random.Random's random, choice and randint
+    methods. rng may be a random.Random, a NumPy Generator, a seed (which
+    makes a new random.Random), or None for the module-level generator
+    that random.seed controls.'''
+    if rng is None:
+        # The Random instance behind random.random, choice and randint.
+        return random.__self__
+    if isinstance(rng, np.random.Generator):
+        return NumpyRandom(rng)
+    if isinstance(rng, (int, float, str, bytes, bytearray)):
+        return Random(rng)
+    return rng
+
+
+# Number of samples along each axis used to find a function's output range.
+CALIBRATION_RESOLUTION = 200
+# Most calibrations kept around so rebuilding a function with the same
+# constants never has to sample it again.
+CALIBRATION_CACHE_SIZE = 65536
+_calibration_cache = {}
+
+
 class Function:
     '''This is the parent class for all functions used.'''
-    def __init__(self):
+    # Every tree holds many of these, so keep them free of a __dict__.
+    # Subclasses declare empty __slots__ for the same reason.
+    __slots__ = ("cx", "cy", "dx", "dy", "zmin", "zmax")
+    # Whether normalized output is clamped to the calibrated range.
+    clamped = True
+    # Python expression used by FunctionNode.compile, where {X} and {Y} are
+    # the scaled and shifted inputs and {x} and {y} the raw ones.
+    source = None
+    # Same as source, but for compile(lut=True) on functions that have a
+    # lookup table version (see eval_lut).
+    lut_source = None
+    # Whether the output depends on each input at all. FunctionNode.simplify
+    # drops the subtree feeding an input that is never read.
+    uses_x = True
+    uses_y = True
+
+    def __init__(self, resolution=None, rng=None):
         '''When a function is made, it will randomly be assigned a
         delta x and y to make sure everything is not centered.
         Additionally, the input of the function will be [-1, 1],
         and the output of the function needs to be [-1, 1].'''
-        self.dx = random() * choice([1, -1]) / 4
-        self.dy = random() * choice([1, -1]) / 4
-        self.cx = random() * choice([1, -1]) + 1
-        self.cy = random() * choice([1, -1]) + 1
-        self.zmin = self.eval(1, 1, False)
-        self.zmax = self.zmin
-        # To constrict output between -1 and 1, we calclate the max
-        # And min output with inputs between -1 and 1, and manipulate
-        # The output accordingly.
-        for ix in range(-100, 100):
-            for iy in range(-100, 100):
-                z = self.eval(ix / 100, iy / 100, False)
-                self.zmin = min(self.zmin, z)
-                self.zmax = max(self.zmax, z)
+        rng = make_rng(rng)
+        self.dx = rng.random() * rng.choice([1, -1]) / 4
+        self.dy = rng.random() * rng.choice([1, -1]) / 4
+        self.cx = rng.random() * rng.choice([1, -1]) + 1
+        self.cy = rng.random() * rng.choice([1, -1]) + 1
+        self.calibrate(resolution)
+
+    def calibrate(self, resolution=None):
+        '''To constrict output between -1 and 1, we calculate the max
+        and min output with inputs between -1 and 1, and manipulate
+        the output accordingly. Functions with analytic bounds are done
+        exactly; the rest are sampled on a resolution x resolution grid
+        (plus the corner (1, 1)), and results are cached by the
+        function's type and constants.'''
+        bounds = self._bounds((-1, 1), (-1, 1))
+        if bounds is not None:
+            self.zmin, self.zmax = float(bounds[0]), float(bounds[1])
+            return
+        if resolution is None:
+            resolution = CALIBRATION_RESOLUTION
+        key = (type(self), self.cx, self.cy, self.dx, self.dy, resolution)
+        bounds = _calibration_cache.get(key)
+        if bounds is None:
+            bounds = self._sample_bounds(resolution)
+            if len(_calibration_cache) >= CALIBRATION_CACHE_SIZE:
+                del _calibration_cache[next(iter(_calibration_cache))]
+            _calibration_cache[key] = bounds
+        self.zmin, self.zmax = bounds
+
+    def _sample_bounds(self, resolution):
+        half = resolution // 2
+        steps = np.arange(-half, half) / half
+        with np.errstate(all='ignore'):
+            z = self.eval_grid(steps[np.newaxis, :], steps[:, np.newaxis], False)
+            z = np.append(z, self.eval_grid(np.float64(1), np.float64(1), False))
+        z = z[np.isfinite(z)]
+        return float(z.min()), float(z.max())
+
+    @classmethod
+    def from_constants(cls, cx, cy, dx, dy, zmin=None, zmax=None):
+        '''Rebuilds a function from known constants. When zmin and zmax are
+        given the function is ready to use without any calibration.'''
+        func = cls.__new__(cls)
+        func.cx, func.cy, func.dx, func.dy = cx, cy, dx, dy
+        if zmin is None or zmax is None:
+            func.calibrate()
+        else:
+            func.zmin, func.zmax = zmin, zmax
+        return func
 
     def eval(self, x, y, normalized=True):
         return
 
+    def eval_grid(self, xs, ys, normalized=True):
+        '''Same as eval, but xs and ys are NumPy arrays of coordinates and
+        the whole array of outputs is returned at once.'''
+        return
+
+    def eval_lut(self, xs, ys, normalized=True):
+        '''Same as eval_grid, but the slowest functions interpolate in shared
+        lookup tables instead, trading a little accuracy for speed.'''
+        return self.eval_grid(xs, ys, normalized)
+
+    def bounds(self, x_interval, y_interval, normalized=True):
+        '''Returns a (low, high) interval containing every output of the
+        function for inputs within x_interval and y_interval.'''
+        z = self._bounds(x_interval, y_interval)
+        if not normalized:
+            return z
+        if z is None:
+            return -1.0, 1.0
+        lo, hi = z
+        if self.clamped:
+            lo = max(self.zmin, min(self.zmax, lo))
+            hi = max(self.zmin, min(self.zmax, hi))
+        return map_to(lo, self.zmin, self.zmax, -1, 1), map_to(hi, self.zmin, self.zmax, -1, 1)
+
+    def _bounds(self, x_interval, y_interval):
+        '''The exact range of the unnormalized output, or None when it has
+        no cheap closed form and has to be sampled instead.'''
+        return None
+
+    def _normalize_grid(self, z):
+        return map_to(_clamp_grid(z, self.zmin, self.zmax), self.zmin, self.zmax, -1, 1)
+
     def __str__(self):
         return str(type(self))[18:-2]
 
 
 class X(Function):
+    __slots__ = ()
+    depth = 0
+
     def __init__(self):
         pass
 
     def eval(self, x, y, normalized=True):
         return x
 
+    def eval_grid(self, xs, ys, normalized=True):
+        return xs
+
+    def bounds(self, x_interval, y_interval, normalized=True):
+        return x_interval
+
     # def __str__(self):
     #     return "x"
 
 
 class Y(Function):
+    __slots__ = ()
+    depth = 0
+
     def __init__(self):
         pass
 
     def eval(self, x, y, normalized=True):
         return y
 
+    def eval_grid(self, xs, ys, normalized=True):
+        return ys
+
+    def bounds(self, x_interval, y_interval, normalized=True):
+        return y_interval
+
     # def __str__(self):
     #     return "y"
 
 
+class Constant(Function):
+    '''A leaf that outputs the same value everywhere. FunctionNode.simplify
+    puts these in place of subtrees that are flat over the image.'''
+    __slots__ = ("value",)
+    depth = 0
+
+    def __init__(self, value=0.0):
+        self.value = float(value)
+
+    def eval(self, x, y, normalized=True):
+        return self.value
+
+    def eval_grid(self, xs, ys, normalized=True):
+        return _broadcast_grid(np.float64(self.value), xs, ys)
+
+    def bounds(self, x_interval, y_interval, normalized=True):
+        return self.value, self.value
+
+    # def __str__(self):
+    #     return str(self.value)
+
+
 class InverseX(Function):
+    __slots__ = ()
+    clamped = False
+    source = "-1 * {X}"
+    uses_y = False
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         z = -1 * newX
@@ -63,11 +236,27 @@ class InverseX(Function):
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        z = -1 * newX
+        if normalized:
+            return map_to(z, self.zmin, self.zmax, -1, 1)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        return -newX[1], -newX[0]
+
     # def __str__(self):
     #     return "-1 * (x * {} + {})".format(self.cx, self.dx)
 
 
 class InverseY(Function):
+    __slots__ = ()
+    clamped = False
+    source = "-1 * {Y}"
+    uses_x = False
+
     def eval(self, x, y, normalized=True):
         newY = y * self.cy + self.dy
         z = -1 * newY
@@ -75,20 +264,56 @@ class InverseY(Function):
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newY = ys * self.cy + self.dy
+        z = -1 * newY
+        if normalized:
+            return map_to(z, self.zmin, self.zmax, -1, 1)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newY = _scale(y_interval, self.cy, self.dy)
+        return -newY[1], -newY[0]
+
     # def __str__(self):
     #     return "-1 * (y * {} + {})".format(self.cy, self.dy)
 
 
 class Ripple(Function):
+    __slots__ = ()
+    source = "{X} * {Y} ** 3 - {Y} * {X} ** 3"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = newX * newY ** 3 - newY * newX ** 3
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = newX * newY ** 3 - newY * newX ** 3
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        # The only interior critical point is the origin; along each edge
+        # the cubic in the free variable peaks at +-(fixed value) / sqrt(3).
+        (a, b), (c, d) = newX, newY
+        points = [(u, v) for u in (a, b) for v in (c, d)]
+        points += [(u, v) for u in (a, b) for v in (u / sqrt(3), -u / sqrt(3)) if c < v < d]
+        points += [(u, v) for v in (c, d) for u in (v / sqrt(3), -v / sqrt(3)) if a < u < b]
+        if a < 0 < b and c < 0 < d:
+            points.append((0, 0))
+        zs = [u * v ** 3 - v * u ** 3 for u, v in points]
+        return min(zs), max(zs)
+
     # def __str__(self):
     #     return "(x * {} + {}) * (y * {} + {}) ** 3 - (y * {} + {}) * (x * {} + {}) ** 3".format(self.cx, self.dx,
     #                                                                                             self.cy, self.dy,
@@ -97,15 +322,32 @@ class Ripple(Function):
 
 
 class Sinkhole(Function):
+    __slots__ = ()
+    source = "({X} ** 2 + {Y} ** 2) * exp(-{X} ** 2 - {Y} ** 2)"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = (newX ** 2 + newY ** 2) * e ** (-newX ** 2 - newY ** 2)
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = (newX ** 2 + newY ** 2) * np.exp(-newX ** 2 - newY ** 2)
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        r = _add(_square(newX), _square(newY))
+        return _extrema(lambda s: s * e ** -s, r, [1])
+
     # def __str__(self):
     #     return "((x * {} + {}) ** 2 + (y * {} + {}) ** 2) * e ** (-(x * {} + {}) ** 2 - (y * {} + {}) ** 2)".format(
     #         self.cx, self.dx, self.cy, self.dy, self.cx, self.dx, self.cy, self.dy
@@ -113,15 +355,36 @@ class Sinkhole(Function):
 
 
 class Pulse(Function):
+    __slots__ = ()
+    source = "-{X} * {Y} * exp(-{X} ** 2 - {Y} ** 2)"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = -newX * newY * e ** (-newX ** 2 - newY ** 2)
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = -newX * newY * np.exp(-newX ** 2 - newY ** 2)
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        # -x * y * e ** (-x ** 2 - y ** 2) splits into a product of x * e ** -x ** 2
+        # and y * e ** -y ** 2, each peaking at +-1 / sqrt(2).
+        peaks = [1 / sqrt(2), -1 / sqrt(2)]
+        z = _mul(_extrema(lambda t: t * e ** (-t ** 2), newX, peaks),
+                 _extrema(lambda t: t * e ** (-t ** 2), newY, peaks))
+        return -z[1], -z[0]
+
     # def __str__(self):
     #     return "-(x * {} + {}) * (y * {} + {}) ** 2) * e ** (-(x * {} + {}) ** 2 - (y * {} + {}) ** 2) ** 2)".format(
     #         self.cx, self.dx, self.cy, self.dy, self.cx, self.dx, self.cy, self.dy
@@ -129,29 +392,62 @@ class Pulse(Function):
 
 
 class Hill(Function):
+    __slots__ = ()
+    source = "cos(abs({X}) + abs({Y}))"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = cos(abs(newX) + abs(newY))
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = np.cos(np.abs(newX) + np.abs(newY))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        return _cos(_add(_abs(newX), _abs(newY)))
+
     # def __str__(self):
     #     return "cos(abs((x * {} + {})) + abs((y * {} + {})))".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Sinkhole2(Function):
+    __slots__ = ()
+    source = "cos(abs({X}) + abs({Y})) * (abs({X}) + abs({Y}))"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = cos(abs(newX) + abs(newY)) * (abs(newX) + abs(newY))
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = np.cos(np.abs(newX) + np.abs(newY)) * (np.abs(newX) + np.abs(newY))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        s = _add(_abs(newX), _abs(newY))
+        return _extrema(lambda t: cos(t) * t, s, _s_cos_s_critical_points(s[1]))
+
     # def __str__(self):
     #     return "cos(abs((x * {} + {})) + abs((y * {} + {}))) * (abs((x * {} + {})) + abs((y * {} + {})))".format(
     #         self.cx, self.dx, self.cy, self.dy, self.cx, self.dx, self.cy, self.dy
@@ -159,15 +455,32 @@ class Sinkhole2(Function):
 
 
 class Ripple2(Function):
+    __slots__ = ()
+    source = "{X} ** 3 - {X} + {Y} ** 3 * {Y}"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = newX ** 3 - newX + newY ** 3 * newY
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = newX ** 3 - newX + newY ** 3 * newY
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        cubic = _extrema(lambda t: t ** 3 - t, newX, [1 / sqrt(3), -1 / sqrt(3)])
+        return _add(cubic, _square(_square(newY)))
+
     # def __str__(self):
     #     return "(x * {} + {}) ** 3 - (x * {} + {}) + (y * {} + {}) ** 3 * (y * {} + {})".format(
     #         self.cx, self.dx, self.cx, self.dx, self.cy, self.dy, self.cy, self.dy
@@ -175,144 +488,298 @@ class Ripple2(Function):
 
 
 class Bendy(Function):
+    __slots__ = ()
+    source = "sin({X} * {Y})"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = sin(newX * newY)
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = np.sin(newX * newY)
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        return _sin(_mul(newX, newY))
+
     # def __str__(self):
     #     return "sin((x * {} + {}) * (y * {} + {}))".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Checkered(Function):
+    __slots__ = ()
+    source = "sin(cos(tan({X}))) * sin(cos(tan({Y})))"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = sin(cos(tan(newX))) * sin(cos(tan(newY)))
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = np.sin(np.cos(np.tan(newX))) * np.sin(np.cos(np.tan(newY)))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        return _mul(_sin_cos_tan(newX), _sin_cos_tan(newY))
+
     # def __str__(self):
     #     return "sin(cos(tan((x * {} + {})))) * sin(cos(tan((y * {} + {}))))".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Checkered2(Function):
+    __slots__ = ()
+    source = "asin(((100 * {x}) % 100) / 100) + asin(((100 * {x}) % 100) / 100)"
+    uses_y = False
+
     def eval(self, x, y, normalized=True):
         newX = ((100 * x) % 100) / 100
         newY = ((100 * x) % 100) / 100
         z = asin(newX) + asin(newY)
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = ((100 * xs) % 100) / 100
+        newY = ((100 * xs) % 100) / 100
+        z = np.arcsin(newX) + np.arcsin(newY)
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
     # def __str__(self):
     #     return "asin((x * {} + {})) + asin((x * {} + {}))".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Sum(Function):
+    __slots__ = ()
+    source = "{X} + {Y}"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = newX + newY
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = newX + newY
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        return _add(newX, newY)
+
     # def __str__(self):
     #     return "(x * {} + {}) + (y * {} + {})".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Product(Function):
+    __slots__ = ()
+    source = "{X} * {Y}"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = newX * newY
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = newX * newY
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        return _mul(newX, newY)
+
     # def __str__(self):
     #     return "(x * {} + {}) * (y * {} + {})".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Mod(Function):
+    __slots__ = ()
+    source = "{X} % {Y}"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = newX % newY
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = newX % newY
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
     # def __str__(self):
     #     return "(x * {} + {}) % (y * {} + {})".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class Mod2(Function):
+    __slots__ = ()
+    source = "{Y} % {X}"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = newY % newX
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = newY % newX
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
     # def __str__(self):
     #     return "(y * {} + {}) % (x * {} + {})".format(self.cy, self.dy, self.cx, self.dx)
 
 
 class Well(Function):
+    __slots__ = ()
+    source = "1 - 2 / ({X} ** 2) ** 8"
+    uses_y = False
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         z = 1 - 2 / (newX ** 2) ** 8
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        z = 1 - 2 / (newX ** 2) ** 8
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        if newX[0] <= 0 <= newX[1]:
+            return None
+        s = _square(newX)
+        return 1 - 2 / s[0] ** 8, 1 - 2 / s[1] ** 8
+
     # def __str__(self):
     #     return "1 - 2 / ((x * {} + {}) ** 2) ** 8".format(self.cx, self.dx)
 
 
 class Well2(Function):
+    __slots__ = ()
+    source = "1 - 2 / ({Y} ** 2) ** 8"
+    uses_x = False
+
     def eval(self, x, y, normalized=True):
         newY = y * self.cy + self.dy
         z = 1 - 2 / (newY ** 2) ** 8
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newY = ys * self.cy + self.dy
+        z = 1 - 2 / (newY ** 2) ** 8
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newY = _scale(y_interval, self.cy, self.dy)
+        if newY[0] <= 0 <= newY[1]:
+            return None
+        s = _square(newY)
+        return 1 - 2 / s[0] ** 8, 1 - 2 / s[1] ** 8
+
     # def __str__(self):
     #     return "1 - 2 / ((x * {} + {}) ** 2) ** 8".format(self.cy, self.dy)
 
 
 class PolarR(Function):
+    __slots__ = ()
+    source = "sqrt({X} ** 2 + {Y} ** 2)"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = sqrt(newX ** 2 + newY ** 2)
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = np.sqrt(newX ** 2 + newY ** 2)
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        r = _add(_square(newX), _square(newY))
+        return sqrt(r[0]), sqrt(r[1])
+
     # def __str__(self):
     #     return "sqrt((x * {} + {}) ** 2 + (y * {} + {}) ** 2)".format(self.cx, self.dx, self.cy, self.dy)
 
 
 class PolarTheta(Function):
+    __slots__ = ()
+    source = "atan({Y} / {X})"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
@@ -330,24 +797,60 @@ class PolarTheta(Function):
                 else:
                     z = 5 * pi / 4
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = np.arctan(newY / newX)
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def _bounds(self, x_interval, y_interval):
+        newX = _scale(x_interval, self.cx, self.dx)
+        newY = _scale(y_interval, self.cy, self.dy)
+        if newX[0] <= 0 <= newX[1]:
+            return -pi / 2, pi / 2
+        ratio = _mul(newY, (1 / newX[1], 1 / newX[0]))
+        return atan(ratio[0]), atan(ratio[1])
+
     # def __str__(self):
     #     return "atan((y * {} + {}) / (x * {} + {}))".format(self.cy, self.dy, self.cx, self.dx)
 
 
 class GammaLower(Function):
+    __slots__ = ()
+    source = "gammainc(abs({X} * 10 + 1), abs({Y} * 10))"
+    lut_source = "gammainc_lut(abs({X} * 10 + 1), abs({Y} * 10))"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = special.gammainc(abs(newX * 10 + 1), abs(newY * 10))
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = special.gammainc(np.abs(newX * 10 + 1), np.abs(newY * 10))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def eval_lut(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = _gammainc_lut(np.abs(newX * 10 + 1), np.abs(newY * 10))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
     # def __str__(self):
     #     return "lowerGamma(abs((x * {} + {}) * 10 + 1), abs((y * {} + {}) * 10))".format(
     #         self.cx, self.dx, self.cy, self.dy
@@ -355,15 +858,35 @@ class GammaLower(Function):
 
 
 class GammaUpper(Function):
+    __slots__ = ()
+    source = "gammainc(abs({X} * 10 + 1), abs({Y} * 10))"
+    lut_source = "gammainc_lut(abs({X} * 10 + 1), abs({Y} * 10))"
+
     def eval(self, x, y, normalized=True):
         newX = x * self.cx + self.dx
         newY = y * self.cy + self.dy
         z = special.gammainc(abs(newX * 10 + 1), abs(newY * 10))
         if normalized:
-            z = max(self.zmin, min(self.zmax, z))
+            z = _clamp(z, self.zmin, self.zmax)
             return map_to(z, self.zmin, self.zmax, -1, 1)
         return z
 
+    def eval_grid(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = special.gammainc(np.abs(newX * 10 + 1), np.abs(newY * 10))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
+    def eval_lut(self, xs, ys, normalized=True):
+        newX = xs * self.cx + self.dx
+        newY = ys * self.cy + self.dy
+        z = _gammainc_lut(np.abs(newX * 10 + 1), np.abs(newY * 10))
+        if normalized:
+            return self._normalize_grid(z)
+        return z
+
     # def __str__(self):
     #     return "upperGamma(abs((x * {} + {}) * 10 + 1), abs((y * {} + {}) * 10))".format(
     #         self.cx, self.dx, self.cy, self.dy
@@ -371,27 +894,30 @@ class GammaUpper(Function):
 
 
 class FunctionNode:
-    def __init__(self, prob, depth=0, func=None):
+    __slots__ = ("func", "left", "right", "depth")
+
+    def __init__(self, prob, depth=0, func=None, rng=None):
+        '''Grows a random tree. Passing the same seeded rng (a random.Random
+        or NumPy Generator) always grows the same tree.'''
+        rng = make_rng(rng)
         # self.func = choice([Ripple, Ripple2, Sinkhole, Sinkhole2, Pulse, Bendy, Checkered, Checkered2, Sum, Product,
         #                     Well, Well2, PolarR, PolarTheta, GammaLower, GammaLower, GammaUpper, GammaUpper, InverseX,
         #                     InverseY])()
         if func is None:
-            self.func = choice([Ripple, Ripple2, Sinkhole, Sinkhole2, Pulse, Bendy, Checkered, Checkered2, Well, Well2,
-                                PolarR, PolarTheta, GammaLower, GammaUpper])()
+            self.func = rng.choice([Ripple, Ripple2, Sinkhole, Sinkhole2, Pulse, Bendy, Checkered, Checkered2, Well,
+                                    Well2, PolarR, PolarTheta, GammaLower, GammaUpper])(rng=rng)
         else:
             self.func = func
-        if depth >= 4 or random() > prob:
+        if depth >= 4 or rng.random() > prob:
             self.left = X()
-            self.left.depth = 0
         else:
             newProb = prob * prob
-            self.left = FunctionNode(newProb, depth + 1)
-        if depth >= 4 or random() > prob:
+            self.left = FunctionNode(newProb, depth + 1, rng=rng)
+        if depth >= 4 or rng.random() > prob:
             self.right = Y()
-            self.right.depth = 0
         else:
             newProb = prob * prob
-            self.right = FunctionNode(newProb, depth + 1)
+            self.right = FunctionNode(newProb, depth + 1, rng=rng)
         self.depth = max(self.left.depth + 1, self.right.depth + 1)
 
     def eval(self, x, y):
@@ -399,6 +925,363 @@ class FunctionNode:
         newY = self.right.eval(x, y)
         return self.func.eval(newX, newY)
 
+    def eval_grid(self, xs, ys, lut=False):
+        '''Evaluates the tree for every point of the coordinate arrays xs and
+        ys at once. The result has the shape of xs and ys broadcast together,
+        so a row of x values and a column of y values give a whole image.
+        With lut True the functions that have lookup tables use them, which
+        is faster but less exact (see GAMMAINC_LUT_MAX_ERROR), for previews
+        and thumbnails.'''
+        with np.errstate(all='ignore'):
+            if lut:
+                newX = self.left.eval_lut(xs, ys)
+                newY = self.right.eval_lut(xs, ys)
+                z = self.func.eval_lut(newX, newY)
+            else:
+                newX = self.left.eval_grid(xs, ys)
+                newY = self.right.eval_grid(xs, ys)
+                z = self.func.eval_grid(newX, newY)
+        return _broadcast_grid(z, xs, ys)
+
+    def eval_lut(self, xs, ys):
+        return self.eval_grid(xs, ys, lut=True)
+
+    def bounds(self, x_interval=(-1, 1), y_interval=(-1, 1)):
+        '''Returns a (low, high) interval that every output of the tree lies
+        in for inputs within x_interval and y_interval, found without
+        evaluating a single point. Useful for rejecting flat trees early.'''
+        newX = self.left.bounds(x_interval, y_interval)
+        newY = self.right.bounds(x_interval, y_interval)
+        return self.func.bounds(newX, newY)
+
+    def simplify(self, tolerance=0.0, x_interval=(-1, 1), y_interval=(-1, 1), resolution=None):
+        '''Returns a copy of the tree that is cheaper to evaluate over
+        x_interval by y_interval. Subtrees feeding an input their parent
+        never reads are dropped, and subtrees whose output varies by no
+        more than tolerance are folded into a Constant.
+
+        Flatness is proven with bounds, so with the default tolerance of 0
+        the simplified tree gives exactly the same output. Passing a
+        resolution also folds subtrees that look flat on a resolution x
+        resolution sample grid, which catches far more of them but can miss
+        features narrower than a sample. When the whole tree is flat a
+        Constant is returned instead of a FunctionNode.'''
+        grid = None
+        if resolution:
+            xs, ys = pixel_grid(resolution, resolution, x_interval, y_interval)
+            # Sample the middle of each cell, plus the far edges.
+            grid = (np.append(xs + (x_interval[1] - x_interval[0]) / (2 * resolution), x_interval[1])[np.newaxis, :],
+                    np.append(ys + (y_interval[1] - y_interval[0]) / (2 * resolution), y_interval[1])[:, np.newaxis])
+        return _simplify_node(self, tolerance, x_interval, y_interval, grid)
+
+    @classmethod
+    def from_parts(cls, func, left, right):
+        '''Builds a node around an existing function and children instead of
+        growing random ones.'''
+        node = cls.__new__(cls)
+        node.func = func
+        node.left = left
+        node.right = right
+        node.depth = max(left.depth + 1, right.depth + 1)
+        return node
+
+    def to_genome(self):
+        '''Returns the tree as a JSON-serializable dict listing every node in
+        preorder along with its constants and calibrated bounds.'''
+        nodes = []
+        for op, params in _genome_nodes(self):
+            name = PRIMITIVES[op].__name__
+            nodes.append([name] if params is None else [name] + list(params))
+        return {"version": GENOME_VERSION, "nodes": nodes}
+
+    @classmethod
+    def from_genome(cls, genome):
+        '''Rebuilds a tree from to_genome's output without recalibrating.'''
+        if genome.get("version") != GENOME_VERSION:
+            raise ValueError("Unsupported genome version: {}".format(genome.get("version")))
+        ops = {primitive.__name__: op for op, primitive in enumerate(PRIMITIVES)}
+        nodes = iter([(ops[node[0]], node[1:] or None) for node in genome["nodes"]])
+        return _build_genome_tree(nodes)
+
+    def to_arrays(self):
+        '''Returns the tree as a TreeArrays, which takes a fraction of the
+        memory and is much cheaper to pickle.'''
+        return TreeArrays.from_tree(self)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''Rebuilds a tree from a TreeArrays without recalibrating.'''
+        return arrays.to_tree()
+
+    def to_bytes(self):
+        '''Returns the genome in its compact binary form: a header, one byte
+        per node for its type, then six doubles per function node.'''
+        return self.to_arrays().to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''Rebuilds a tree from to_bytes's output without recalibrating.'''
+        return TreeArrays.from_bytes(data).to_tree()
+
+    def compile(self, vectorized=False, lut=False):
+        '''Flattens the tree into a single generated Python function with
+        every node's constants baked in, so evaluating it costs no recursion
+        or attribute lookups. The result is called like eval, or like
+        eval_grid when vectorized is True. Vectorized functions can also use
+        the lookup tables, like eval_grid with lut True.'''
+        if lut and not vectorized:
+            raise ValueError("Lookup tables are only used by vectorized functions")
+        lines = []
+        result = _compile_node(self, lines, vectorized, lut)
+        if vectorized:
+            body = ["    with errstate(all='ignore'):"] + ["        " + line for line in lines]
+            body.append("    return broadcast({}, x, y)".format(result))
+        else:
+            body = ["    " + line for line in lines] + ["    return {}".format(result)]
+        source = "def compiled(x, y):\n" + "\n".join(body) + "\n"
+        namespace = dict(_VECTOR_NAMESPACE if vectorized else _SCALAR_NAMESPACE)
+        exec(compile(source, "<FunctionNode.compile>", "exec"), namespace)
+        compiled = namespace["compiled"]
+        compiled.source = source
+        return compiled
+
+
+class TreeArrays:
+    '''A tree stored as a structure of arrays rather than linked objects.
+    ops holds the index into PRIMITIVES of every node in preorder, and params
+    the (cx, cy, dx, dy, zmin, zmax) of every node other than X and Y, in the
+    same order. Meant for holding large batches of trees and handing them to
+    other processes; convert back with to_tree to evaluate one.'''
+    __slots__ = ("ops", "params")
+
+    def __init__(self, ops, params):
+        self.ops = np.asarray(ops, dtype=np.uint8)
+        self.params = np.asarray(params, dtype=np.float64).reshape(-1, 6)
+
+    @classmethod
+    def from_tree(cls, root):
+        ops = []
+        params = []
+        for op, node_params in _genome_nodes(root):
+            ops.append(op)
+            if node_params is not None:
+                params.append(node_params)
+        return cls(ops, params)
+
+    def to_tree(self):
+        params = iter(self.params.tolist())
+        nodes = iter([(op, None if PRIMITIVES[op] in (X, Y) else next(params)) for op in self.ops.tolist()])
+        return _build_genome_tree(nodes)
+
+    def to_bytes(self):
+        return (struct.pack(_GENOME_HEADER, _GENOME_MAGIC, GENOME_VERSION, len(self.ops)) +
+                self.ops.tobytes() + self.params.astype("<f8").tobytes())
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, count = struct.unpack_from(_GENOME_HEADER, data)
+        if magic != _GENOME_MAGIC:
+            raise ValueError("Not a FunctionNode genome")
+        if version != GENOME_VERSION:
+            raise ValueError("Unsupported genome version: {}".format(version))
+        offset = struct.calcsize(_GENOME_HEADER)
+        ops = np.frombuffer(data, np.uint8, count, offset)
+        params = np.frombuffer(data, "<f8", offset=offset + count)
+        return cls(ops, params)
+
+    def __reduce__(self):
+        # Pickle as the binary genome, which is far smaller than two arrays.
+        return TreeArrays.from_bytes, (self.to_bytes(),)
+
+    def __len__(self):
+        return len(self.ops)
+
+
+# Genome op codes are indexes into PRIMITIVES, so only ever append to it.
+PRIMITIVES = (X, Y, InverseX, InverseY, Ripple, Sinkhole, Pulse, Hill, Sinkhole2, Ripple2, Bendy, Checkered,
+              Checkered2, Sum, Product, Mod, Mod2, Well, Well2, PolarR, PolarTheta, GammaLower, GammaUpper,
+              Constant)
+# Bump this if what a stored zmin and zmax mean to eval ever changes, so old
+# genomes are refused rather than drawn differently. The cache keys on the
+# genome, so its entries then miss too. A change in how calibrate finds the
+# bounds, as the move to analytic bounds, needs no bump: saved genomes keep
+# their bounds. It does change every tree grown from a seed, and so every
+# named or seeded output.
+GENOME_VERSION = 1
+_GENOME_MAGIC = b"RPT"
+_GENOME_HEADER = "<3sBI"
+
+
+def _simplify_node(node, tolerance, x_interval, y_interval, grid):
+    if not isinstance(node, FunctionNode):
+        return node
+    func = node.func
+    left = _simplify_node(node.left, tolerance, x_interval, y_interval, grid) if func.uses_x else X()
+    right = _simplify_node(node.right, tolerance, x_interval, y_interval, grid) if func.uses_y else Y()
+    node = FunctionNode.from_parts(func, left, right)
+    lo, hi = node.bounds(x_interval, y_interval)
+    if hi - lo <= tolerance:
+        return Constant((lo + hi) / 2)
+    if grid is not None:
+        z = node.eval_grid(*grid)
+        lo, hi = z.min(), z.max()
+        if np.isfinite(lo) and np.isfinite(hi) and hi - lo <= tolerance:
+            return Constant((lo + hi) / 2)
+    return node
+
+
+def _genome_nodes(root):
+    '''Yields (op code, params) for every node of the tree in preorder, where
+    params is (cx, cy, dx, dy, zmin, zmax), or None for the X and Y leaves.'''
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (X, Y)):
+            yield PRIMITIVES.index(type(node)), None
+            continue
+        if isinstance(node, Constant):
+            yield PRIMITIVES.index(Constant), (1.0, 1.0, 0.0, 0.0, node.value, node.value)
+            continue
+        func = node.func
+        yield PRIMITIVES.index(type(func)), (func.cx, func.cy, func.dx, func.dy, func.zmin, func.zmax)
+        stack.append(node.right)
+        stack.append(node.left)
+
+
+def _build_genome_tree(nodes):
+    op, params = next(nodes)
+    primitive = PRIMITIVES[op]
+    if primitive in (X, Y):
+        return primitive()
+    if primitive is Constant:
+        return Constant(params[4])
+    func = primitive.from_constants(*params)
+    left = _build_genome_tree(nodes)
+    right = _build_genome_tree(nodes)
+    return FunctionNode.from_parts(func, left, right)
+
+
+_SCALAR_NAMESPACE = {
+    "exp": exp, "sin": sin, "cos": cos, "tan": tan, "asin": asin, "atan": atan, "sqrt": sqrt,
+    "gammainc": special.gammainc
+}
+_VECTOR_NAMESPACE = {
+    "exp": np.exp, "sin": np.sin, "cos": np.cos, "tan": np.tan, "asin": np.arcsin, "atan": np.arctan,
+    "sqrt": np.sqrt, "abs": np.abs, "gammainc": special.gammainc, "clamp": lambda z, lo, hi: _clamp_grid(z, lo, hi),
+    "broadcast": lambda z, xs, ys: _broadcast_grid(z, xs, ys), "errstate": np.errstate,
+    "gammainc_lut": lambda a, x: _gammainc_lut(a, x)
+}
+
+
+def _compile_node(node, lines, vectorized, lut=False):
+    '''Appends the statements evaluating node to lines and returns the name
+    of the variable holding its (normalized) output.'''
+    if isinstance(node, X):
+        return "x"
+    if isinstance(node, Y):
+        return "y"
+    if isinstance(node, Constant):
+        return repr(node.value)
+    x = _compile_node(node.left, lines, vectorized, lut)
+    y = _compile_node(node.right, lines, vectorized, lut)
+    func = node.func
+    source = func.lut_source if lut and func.lut_source else func.source
+    n = len(lines)
+    names = {"x": x, "y": y, "X": "X{}".format(n), "Y": "Y{}".format(n)}
+    temporaries = [name for name in (x, y) if name.startswith("z")]
+    if "{X}" in source:
+        lines.append("X{} = {} * {!r} + {!r}".format(n, x, func.cx, func.dx))
+        temporaries.append(names["X"])
+    if "{Y}" in source:
+        lines.append("Y{} = {} * {!r} + {!r}".format(n, y, func.cy, func.dy))
+        temporaries.append(names["Y"])
+    z = "z{}".format(n)
+    lines.append("{} = {}".format(z, source.format(**names)))
+    if vectorized and temporaries:
+        # Free intermediate arrays as soon as they are used up.
+        lines.append("del " + ", ".join(temporaries))
+    if func.clamped:
+        if vectorized:
+            lines.append("{0} = clamp({0}, {1!r}, {2!r})".format(z, func.zmin, func.zmax))
+        else:
+            # Same result as _clamp, NaN included.
+            lines.append("{0} = {1!r} if not {0} >= {1!r} else ({0} if {0} <= {2!r} else {2!r})".format(
+                z, func.zmin, func.zmax))
+    # Written out the way map_to computes it.
+    lines.append("{0} = -1 + 2 * ({0} - {1!r}) / {2!r}".format(z, func.zmin, func.zmax - func.zmin))
+    return z
+
+
+def _clamp(z, lo, hi):
+    # NaN goes to lo, as in _clamp_grid, where max(lo, min(hi, z)) would
+    # quietly give hi instead.
+    return lo if not z >= lo else (z if z <= hi else hi)
+
+
+def _clamp_grid(z, lo, hi):
+    # Points where eval would raise (division by zero and the like) are
+    # pinned to the nearest bound instead, and NaN to lo as in _clamp.
+    z = np.nan_to_num(z, nan=lo, posinf=hi, neginf=lo)
+    return np.clip(z, lo, hi)
+
+
+def _broadcast_grid(z, xs, ys):
+    shape = np.broadcast(xs, ys).shape
+    if np.shape(z) != shape:
+        z = np.broadcast_to(z, shape).copy()
+    return z
+
+
+# Lookup table behind GammaLower.eval_lut and GammaUpper.eval_lut. It is
+# built the first time it is needed and then shared by every tree.
+GAMMAINC_LUT_SIZE = 1024
+GAMMAINC_LUT_LIMIT = 64
+# For small a, gammainc(a, x) climbs from 0 to nearly 1 within the first few
+# columns of the table, x < (8 / 128) ** 2, too steeply to interpolate, so
+# those are worked out exactly. They hold hardly any pixels.
+GAMMAINC_LUT_EXACT_COLUMNS = 8
+# Bound on the difference from scipy.special.gammainc anywhere on the table,
+# before the function's output is normalized. The largest seen, sampling 15 x
+# 15 points inside every cell, was 1.75e-4. _normalize_grid then scales it by
+# 2 / (zmax - zmin): most GammaLower and GammaUpper calibrate to nearly all of
+# [0, 1], and over 600 of them the previews were at most 3.5e-4 off, under a
+# twentieth of a level of a band with a range of 256.
+GAMMAINC_LUT_MAX_ERROR = 2e-4
+_lookup_tables = {}
+
+
+def _gammainc_lut(a, x):
+    '''gammainc(a, x) by bilinear interpolation in a table spaced evenly in
+    sqrt(a) and sqrt(x), since it changes fastest near zero. Points off the
+    table, in its first row where gammainc(0, x) jumps from 0 to 1, and in
+    its first GAMMAINC_LUT_EXACT_COLUMNS columns are worked out exactly.'''
+    table = _lookup_tables.get("gammainc")
+    if table is None:
+        steps = np.linspace(0, sqrt(GAMMAINC_LUT_LIMIT), GAMMAINC_LUT_SIZE + 1) ** 2
+        table = _lookup_tables["gammainc"] = special.gammainc(steps[:, np.newaxis], steps[np.newaxis, :]).ravel()
+    # Work out each axis before broadcasting, so a row of a and a column of
+    # x only pay for the table reads at full size.
+    inside_a, pa, ia, fa = _lut_axis(a)
+    inside_x, px, ix, fx = _lut_axis(x)
+    index = ia * (GAMMAINC_LUT_SIZE + 1) + ix
+    top = table[index] + (table[index + 1] - table[index]) * fx
+    index += GAMMAINC_LUT_SIZE + 1
+    bottom = table[index] + (table[index + 1] - table[index]) * fx
+    z = np.asarray(top + (bottom - top) * fa)
+    inside = inside_a & inside_x & (pa >= 1) & (px >= GAMMAINC_LUT_EXACT_COLUMNS)
+    if not inside.all():
+        a, x = np.broadcast_arrays(a, x)
+        outside = ~inside
+        z[outside] = special.gammainc(a[outside], x[outside])
+    return z
+
+
+def _lut_axis(v):
+    inside = (v >= 0) & (v <= GAMMAINC_LUT_LIMIT)
+    p = np.sqrt(np.where(inside, v, 0)) * (GAMMAINC_LUT_SIZE / sqrt(GAMMAINC_LUT_LIMIT))
+    i = np.minimum(p.astype(np.intp), GAMMAINC_LUT_SIZE - 1)
+    return inside, p, i, p - i
+
 
 def createTree(root):
     tree = [str(root.func)]
@@ -417,7 +1300,7 @@ def createTree(root):
             queue.append(None)
             queue.append(None)
             tree.append("#")
-        elif type(curNode) in [X, Y]:
+        elif type(curNode) in [X, Y, Constant]:
             queue.append(None)
             queue.append(None)
             tree.append(str(curNode))
@@ -447,6 +1330,25 @@ def _printTree(tree, depth):
     return s
 
 
+def save_genome(root, filename):
+    '''Writes the tree's genome to filename, as JSON if the name ends in
+    .json and in the binary format otherwise.'''
+    if filename.endswith(".json"):
+        with open(filename, 'w') as f:
+            json.dump(root.to_genome(), f)
+    else:
+        with open(filename, 'wb') as f:
+            f.write(root.to_bytes())
+
+
+def load_genome(filename):
+    if filename.endswith(".json"):
+        with open(filename) as f:
+            return FunctionNode.from_genome(json.load(f))
+    with open(filename, 'rb') as f:
+        return FunctionNode.from_bytes(f.read())
+
+
 def saveTree(root, filename):
     tree, depth = createTree(root)
     with open("tests/{}".format(filename), 'w') as f:
@@ -459,6 +1361,79 @@ def map_to(value, old_min, old_max, new_min, new_max):
     return new_min + new_range * (value - old_min) / old_range
 
 
+def pixel_grid(width, height, x_range=(-1, 1), y_range=(-1, 1)):
+    '''Returns a row of x coordinates and a column of y coordinates mapping
+    pixel indices onto the given ranges, ready to be passed to eval_grid.'''
+    xs = map_to(np.arange(width), 0, width, x_range[0], x_range[1])
+    ys = map_to(np.arange(height), 0, height, y_range[0], y_range[1])
+    return xs[np.newaxis, :], ys[:, np.newaxis]
+
+
+# Interval helpers for Function._bounds. Intervals are (low, high) tuples.
+def _scale(interval, c, d):
+    lo, hi = interval[0] * c + d, interval[1] * c + d
+    return (lo, hi) if lo <= hi else (hi, lo)
+
+
+def _add(a, b):
+    return a[0] + b[0], a[1] + b[1]
+
+
+def _mul(a, b):
+    products = a[0] * b[0], a[0] * b[1], a[1] * b[0], a[1] * b[1]
+    return min(products), max(products)
+
+
+def _abs(interval):
+    lo, hi = interval
+    if lo >= 0:
+        return lo, hi
+    if hi <= 0:
+        return -hi, -lo
+    return 0, max(-lo, hi)
+
+
+def _square(interval):
+    lo, hi = _abs(interval)
+    return lo * lo, hi * hi
+
+
+def _extrema(f, interval, critical_points=()):
+    '''The range of a continuous f over interval, given the points where
+    its derivative vanishes.'''
+    lo, hi = interval
+    zs = [f(lo), f(hi)] + [f(p) for p in critical_points if lo < p < hi]
+    return min(zs), max(zs)
+
+
+def _cos(interval):
+    lo, hi = interval
+    if hi - lo >= 2 * pi:
+        return -1.0, 1.0
+    return _extrema(cos, interval, [k * pi for k in range(ceil(lo / pi), floor(hi / pi) + 1)])
+
+
+def _sin(interval):
+    return _cos((interval[0] - pi / 2, interval[1] - pi / 2))
+
+
+def _sin_cos_tan(interval):
+    lo, hi = interval
+    if ceil((lo - pi / 2) / pi) <= floor((hi - pi / 2) / pi):
+        # tan passes through a pole, so it takes every value.
+        return sin(-1), sin(1)
+    t = _cos((tan(lo), tan(hi)))
+    return sin(t[0]), sin(t[1])
+
+
+def _s_cos_s_critical_points(limit):
+    '''Non-negative roots of d/ds (s * cos(s)) = cos(s) - s * sin(s) up to
+    limit. There is exactly one in each [k * pi, k * pi + pi / 2].'''
+    def derivative(s):
+        return cos(s) - s * sin(s)
+    return [optimize.brentq(derivative, k * pi, k * pi + pi / 2) for k in range(int(limit // pi) + 1)]
+
+
 if __name__ == '__main__':
     root = FunctionNode(1)
     print(root.depth)
@@ -466,4 +1441,3 @@ if __name__ == '__main__':
     # Functions to add:
     #   Pascal's Triangle with mods
     #   Newton's method fractal (0)
-
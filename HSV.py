@@ -1,15 +1,19 @@
-import multiprocessing
-
+from Batch import *
+from Channels import *
 from Functions import *
+from Render import *
+from Scheduler import *
+from Stream import *
 from PIL import Image as PILImage
 from PIL import ImageTk
-from random import randint
+from functools import partial
+from os import environ
 from random import seed
 from sys import argv
 from tkinter import *
 
 
-class HSVImage:
+class HSVImage(ChannelImage):
     """
     The HSVImage is a class comprised of three separate Function Trees:
         Hue
@@ -19,120 +23,43 @@ class HSVImage:
     Args:
         width (int): The width of the image to generate.
         height (int): The height of the image to generate.
+        rng: The random.Random or NumPy Generator used to build the trees. Defaults to
+             the module-level generator that random.seed controls.
+        lut (bool): Whether to evaluate the trees with the faster, approximate lookup tables.
+        pool (RenderPool): The pool that renders the trees. Defaults to the shared one.
+        render (bool): Whether to render the values now, rather than leaving them to generate.
 
     Attributes:
         width (int): The width of the image to generate.
         height (int): The height of the image to generate.
+        lut (bool): Whether the trees are evaluated with the lookup tables.
+        pool (RenderPool): The pool that renders the trees, or None for the shared one.
         hue (dict): All information related to the hue values for every pixel.
             tree (FunctionNode): The Functional Tree to calculate the values.
-            values (list): The list of floats of values for the hues.
+            values (ndarray): The flat array of floats of values for the hues.
             shift (int): The amount every hue value is shifted.
             range (int): The range of the hue values.
         sat (dict): All information related to the saturation values for every pixel.
             tree (FunctionNode): The Functional Tree to calculate the values.
-            values (list): The list of floats of values for the saturation.
+            values (ndarray): The flat array of floats of values for the saturation.
             shift (int): The amount every saturation value is shifted.
             range (int): The range of the saturation values.
 
     Methods:
+        All from ChannelImage, which renders and quantizes the channels:
         new: Assigns new Functional Trees to the hue, saturation, and value, and calls
              generate on the new trees.
+        new_channel: Assigns a new Functional Tree to one of them, and generates it.
         generate: Generates the values for each tree in hue, saturation, and value.
+        image: Makes the RGB image of the values, with the current shifts and ranges.
+        stream: Renders the image to a PNG a strip of rows at a time.
+        save_values: Saves the raw values to a memory-mapped .npy file.
+        load_values: Rebuilds an HSVImage from saved values, without evaluating its trees.
     """
-    def __init__(self, width: int, height: int):
-        self.width = width
-        self.height = height
-        self.hue = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.sat = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.val = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.generate()
-
-    def generate(self):
-        """Sets the hue, saturation, and value values."""
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-
-        jobs = []
-        for func in self._generate_hues, self._generate_sats, self._generate_vals:
-            p = multiprocessing.Process(target=func, args=(return_dict,))
-            jobs.append(p)
-            p.start()
-        for proc in jobs:
-            proc.join()
-
-        self.hue["values"] = return_dict["hue"]
-        self.sat["values"] = return_dict["sat"]
-        self.val["values"] = return_dict["val"]
-
-    def _generate_hues(self, return_dict=None):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.hue["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["hue"] = values
-        else:
-            self.hue["values"] = values
-
-    def _generate_sats(self, return_dict=None):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.sat["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["sat"] = values
-        else:
-            self.sat["values"] = values
-
-    def _generate_vals(self, return_dict=None):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.val["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["val"] = values
-        else:
-            self.val["values"] = values
-
-    def _new_hue(self, complexity=0.6):
-        self.hue["tree"] = FunctionNode(complexity)
-        self._generate_hues()
-
-    def _new_sat(self, complexity=0.6):
-        self.sat["tree"] = FunctionNode(complexity)
-        self._generate_sats()
-
-    def _new_val(self, complexity=0.6):
-        self.val["tree"] = FunctionNode(complexity)
-        self._generate_vals()
-
-    def new(self, complexity=(0.6, 0.6, 0.6)):
-        """Creates new trees for hue, saturation, and value, and then generates values for these."""
-        self.hue["tree"] = FunctionNode(complexity[0])
-        self.sat["tree"] = FunctionNode(complexity[1])
-        self.val["tree"] = FunctionNode(complexity[2])
-        self.generate()
+    CHANNELS = (("hue", (0, 255), (1, 256)),
+                ("sat", (0, 255), (1, 256)),
+                ("val", (0, 255), (1, 256)))
+    MODE = "HSV"
 
 
 class GUI:
@@ -185,68 +112,57 @@ class GUI:
             pil_image (PILImage): The PIL Image that the HSV Image is rendered onto.
             tk_image (PhotoImage): This is used to render the PIL Image onto the Tkinter Frame.
             bands (list): The list of hue, saturation, and value bands that combine to make the image.
+            levels (list): The 16-bit levels of each channel's values, which the bands are remapped from.
+            scheduler (RenderScheduler): Runs the renders off the Tk thread.
+            full_values (list): The tree and 1200x800 values of each channel, rendered ahead for saving.
+            save_scheduler (RenderScheduler): Renders the full size values in the background.
         """
         def __init__(self, master):
             self.master = master
             self.frame = Frame(self.master)
-            self.hsv_image = HSVImage(600, 400)
+            # Rendered exactly, not with the lookup tables, so that saving can
+            # reuse the preview's values as a quarter of the full size grid.
+            self.hsv_image = HSVImage(600, 400, render=False)
             self.pil_image = PILImage.new("HSV", (600, 400))
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
             self.visibilities = [True, True, True]
             self.bands = [PILImage.new("L", (600, 400)), PILImage.new("L", (600, 400)), PILImage.new("L", (600, 400))]
-
-        def _generate_hue_band(self, return_dict=None):
-            data = []
-            for i in self.hsv_image.hue["values"]:
-                data.append(round(map_to(i, -1, 1, 0, self.hsv_image.hue["range"]) + self.hsv_image.hue["shift"]) % 256)
-            if return_dict:
-                img = PILImage.new("L", (600, 400))
-                img.putdata(data)
-                return_dict["hue_band"] = img
-            else:
-                self.bands[0].putdata(data)
-
-        def _generate_sat_band(self, return_dict=None):
-            data = []
-            for i in self.hsv_image.sat["values"]:
-                data.append(round(map_to(i, -1, 1, 0, self.hsv_image.sat["range"]) + self.hsv_image.sat["shift"]) % 256)
-            if return_dict:
-                img = PILImage.new("L", (600, 400))
-                img.putdata(data)
-                return_dict["sat_band"] = img
-            else:
-                self.bands[1].putdata(data)
-
-        def _generate_val_band(self, return_dict=None):
-            data = []
-            for i in self.hsv_image.val["values"]:
-                data.append(round(map_to(i, -1, 1, 0, self.hsv_image.val["range"]) + self.hsv_image.val["shift"]) % 256)
-            if return_dict:
-                img = PILImage.new("L", (600, 400))
-                img.putdata(data)
-                return_dict["val_band"] = img
-            else:
-                self.bands[2].putdata(data)
+            self.levels = [None, None, None]
+            self.level_values = [None, None, None]
+            self.scheduler = RenderScheduler(self.master)
+            self.full_values = [None, None, None]
+            self.speculated = [None, None, None]
+            self.save_scheduler = RenderScheduler(self.master)
+            self.refine("new", 0, 1, 2, new=False)
+
+        def _levels(self, i, values):
+            # Quantized once for each new tree; the sliders only change the table.
+            if self.level_values[i] is not values:
+                self.level_values[i] = values
+                self.levels[i] = channel_levels(values)
+            return self.levels[i]
+
+        def _generate_hue_band(self):
+            hue = self.hsv_image.hue
+            self.bands[0] = remap_band(self._levels(0, hue["values"]), hue["shift"], hue["range"], 600, 400)
+
+        def _generate_sat_band(self):
+            sat = self.hsv_image.sat
+            self.bands[1] = remap_band(self._levels(1, sat["values"]), sat["shift"], sat["range"], 600, 400)
+
+        def _generate_val_band(self):
+            val = self.hsv_image.val
+            self.bands[2] = remap_band(self._levels(2, val["values"]), val["shift"], val["range"], 600, 400)
 
         def generate(self):
             """Sets the bands for each hue, saturation, and value."""
-            manager = multiprocessing.Manager()
-            return_dict = manager.dict()
-
-            jobs = []
             for func in self._generate_hue_band, self._generate_sat_band, self._generate_val_band:
-                p = multiprocessing.Process(target=func, args=(return_dict,))
-                jobs.append(p)
-                p.start()
-            for proc in jobs:
-                proc.join()
-
-            self.bands = return_dict["hue_band"], return_dict["sat_band"], return_dict["val_band"]
+                func()
 
-        def update(self):
-            """Combines the bands into the PIL Image and updates the tk_image."""
+        def compose(self):
+            """Combines the bands into a PIL Image."""
             bands = []
             if self.visibilities[0]:
                 bands.append(self.bands[0])
@@ -260,12 +176,97 @@ class GUI:
                 bands.append(self.bands[2])
             else:
                 bands.append(PILImage.new("L", (600, 400), color=self.hsv_image.val["shift"]))
-            self.pil_image = PILImage.merge("HSV", bands)
+            return PILImage.merge("HSV", bands)
+
+        def show(self, pil_image):
+            """Shows a PIL Image from compose, updating the tk_image."""
+            self.pil_image = pil_image
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label.destroy()
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
 
+        def update(self):
+            """Combines the bands into the PIL Image and updates the tk_image."""
+            self.show(self.compose())
+
+        def render(self, key, *steps, delay=0):
+            """
+            Runs the steps off the Tk thread, then shows the new preview.
+            :param key: Renders under the same key supersede each other, see RenderScheduler.
+            :param steps: Functions that update the HSV Image and the bands.
+            :param delay: Milliseconds to wait for a newer render first.
+            """
+            def work(cancelled):
+                for step in steps:
+                    if cancelled():
+                        return None
+                    step()
+                return self.compose(), [(channel["tree"], channel["values"]) for channel in self.channels()]
+
+            def done(result):
+                pil_image, trees = result
+                self.show(pil_image)
+                self.speculate(trees)
+
+            self.scheduler.submit(key, work, done, delay)
+
+        def refine(self, key, *indexes, new=True):
+            """
+            Renders channels coarse to fine off the Tk thread, showing the preview
+            after every pass, the first at an eighth of the size.
+            :param key: Renders under the same key supersede each other, see RenderScheduler.
+            :param indexes: The indexes of the channels, as in channels.
+            :param new: Whether to give the channels new trees first.
+            """
+            def work(cancelled, report):
+                channels = [self.channels()[i] for i in indexes]
+                trees = [self.hsv_image.new_tree() if new else channel["tree"] for channel in channels]
+                passes = zip(*[progressive_values(tree, 600, 400, lut=self.hsv_image.lut, pool=self.hsv_image.pool)
+                               for tree in trees])
+                for values in passes:
+                    if cancelled():
+                        return None
+                    for i, channel, channel_values in zip(indexes, channels, values):
+                        self.bands[i] = remap_band(self._levels(i, channel_values), channel["shift"], channel["range"],
+                                                   600, 400)
+                    report(self.compose())
+                for channel, tree, channel_values in zip(channels, trees, values):
+                    channel.update(tree=tree, values=channel_values)
+                return [(channel["tree"], channel["values"]) for channel in self.channels()]
+
+            self.scheduler.submit(key, work, self.speculate, progress=self.show)
+
+        def channels(self):
+            return self.hsv_image.hue, self.hsv_image.sat, self.hsv_image.val
+
+        def speculate(self, trees):
+            """
+            Starts rendering each new tree exactly at the full 1200x800 size in the
+            background, see Render.exact_values, so that saving finds them ready.
+            :param trees: The tree and preview values of each channel.
+            """
+            for i, (tree, values) in enumerate(trees):
+                if self.speculated[i] is not tree:
+                    self.speculated[i] = tree
+                    self._speculate(i, tree, values)
+
+        def _speculate(self, i, tree, values):
+            def work(cancelled):
+                return exact_values(tree, values, 1200, 800, self.hsv_image.lut, self.hsv_image.pool)
+
+            def done(full):
+                self.full_values[i] = tree, full
+
+            self.save_scheduler.submit(i, work, done)
+
+        def full_size_values(self, i):
+            """The 1200x800 values of a channel, rendered now unless speculate already has."""
+            tree, values = self.channels()[i]["tree"], self.channels()[i]["values"]
+            if self.full_values[i] is not None and self.full_values[i][0] is tree:
+                return self.full_values[i][1]
+            return exact_values(tree, values, 1200, 800, self.hsv_image.lut, self.hsv_image.pool)
+
     def __init__(self, master):
         self.master = master
         self.frame = Frame(self.master)
@@ -320,37 +321,31 @@ class GUI:
         self.save_button.grid(row=4, column=6)
 
     def update_hue(self, n=None):
-        self.preview.hsv_image.hue["range"] = self.hue_range.get()
-        self.preview.hsv_image.hue["shift"] = self.hue_shift.get()
-        self.preview._generate_hue_band()
-        self.preview.update()
+        hue = self.preview.hsv_image.hue
+        stretch, shift = self.hue_range.get(), self.hue_shift.get()
+        self.preview.render("hue", lambda: hue.update(range=stretch, shift=shift), self.preview._generate_hue_band,
+                            delay=SLIDER_DELAY)
 
     def new_hue_tree(self):
-        self.preview.hsv_image._new_hue()
-        self.preview._generate_hue_band()
-        self.preview.update()
+        self.preview.refine("new hue", 0)
 
     def update_sat(self, n=None):
-        self.preview.hsv_image.sat["range"] = self.sat_range.get()
-        self.preview.hsv_image.sat["shift"] = self.sat_shift.get()
-        self.preview._generate_sat_band()
-        self.preview.update()
+        sat = self.preview.hsv_image.sat
+        stretch, shift = self.sat_range.get(), self.sat_shift.get()
+        self.preview.render("sat", lambda: sat.update(range=stretch, shift=shift), self.preview._generate_sat_band,
+                            delay=SLIDER_DELAY)
 
     def new_sat_tree(self):
-        self.preview.hsv_image._new_sat()
-        self.preview._generate_sat_band()
-        self.preview.update()
+        self.preview.refine("new sat", 1)
 
     def update_val(self, n=None):
-        self.preview.hsv_image.val["range"] = self.val_range.get()
-        self.preview.hsv_image.val["shift"] = self.val_shift.get()
-        self.preview._generate_val_band()
-        self.preview.update()
+        val = self.preview.hsv_image.val
+        stretch, shift = self.val_range.get(), self.val_shift.get()
+        self.preview.render("val", lambda: val.update(range=stretch, shift=shift), self.preview._generate_val_band,
+                            delay=SLIDER_DELAY)
 
     def new_val_tree(self):
-        self.preview.hsv_image._new_val()
-        self.preview._generate_val_band()
-        self.preview.update()
+        self.preview.refine("new val", 2)
 
     def toggle_hue(self):
         self.preview.visibilities[0] = not self.preview.visibilities[0]
@@ -358,7 +353,7 @@ class GUI:
         self.hue_visible.destroy()
         self.hue_visible = Button(self.master, text=text, command=self.toggle_hue)
         self.hue_visible.grid(row=1, column=6)
-        self.preview.update()
+        self.preview.render("visibility")
 
     def toggle_sat(self):
         self.preview.visibilities[1] = not self.preview.visibilities[1]
@@ -366,7 +361,7 @@ class GUI:
         self.sat_visible.destroy()
         self.sat_visible = Button(self.master, text=text, command=self.toggle_sat)
         self.sat_visible.grid(row=2, column=6)
-        self.preview.update()
+        self.preview.render("visibility")
 
     def toggle_val(self):
         self.preview.visibilities[2] = not self.preview.visibilities[2]
@@ -374,52 +369,53 @@ class GUI:
         self.val_visible.destroy()
         self.val_visible = Button(self.master, text=text, command=self.toggle_val)
         self.val_visible.grid(row=3, column=6)
-        self.preview.update()
+        self.preview.render("visibility")
 
     def save(self):
-        visibility = self.preview.visibilities
-        color = self.preview.hsv_image.hue, self.preview.hsv_image.sat, self.preview.hsv_image.val
-        bands = [generate_band(1200, 800, visibility[i], color[i]["tree"], color[i]["shift"], color[i]["range"]) for i in range(3)]
+        visibility = list(self.preview.visibilities)
+        name = self.save_name.get()
 
-        final_image = PILImage.merge("HSV", bands).convert("RGB")
-        final_image.save(self.save_name.get() + ".png", "PNG")
+        def work(cancelled):
+            bands = []
+            for i, channel in enumerate(self.preview.channels()):
+                if visibility[i]:
+                    values = self.preview.full_size_values(i)
+                    bands.append(value_band(values, 1200, 800, channel["shift"], channel["range"]))
+                else:
+                    bands.append(PILImage.new("L", (1200, 800), color=channel["shift"]))
 
+            final_image = PILImage.merge("HSV", bands).convert("RGB")
+            final_image.save(name + ".png", "PNG")
 
-def generate_band(width: int, height: int, visible: bool, head: FunctionNode, shift: int, stretch: int):
-    """
-    Generates a band with the given input.
-    :param width:
-    :param height:
-    :param visible:
-    :param head:
-    :param shift:
-    :param stretch:
-    :return:
-    """
-    if visible:
-        band = PILImage.new("L", (width, height))
-        data = []
-        for y in range(height):
-            adjusted_y = 2 * y / height
-            for x in range(width):
-                adjusted_x = 2 * x / width
-                data.append(((head.eval(adjusted_x, adjusted_y) / 2 + 0.5) * stretch + shift) % 256)
-        band.putdata(data)
-    else:
-        band = PILImage.new("L", (width, height), color=shift)
-    return band
+        self.preview.scheduler.submit(("save", name), work)
 
 
-def save_HSV(width, height, name):
-    hsv_image = HSVImage(width, height)
-    color = hsv_image.hue, hsv_image.sat, hsv_image.val
-    bands = [generate_band(width, height, True, color[i]["tree"], color[i]["shift"], color[i]["range"]) for i in range(3)]
+def save_HSV(width, height, name, rng=None, pool=None, values=False, tolerance=None):
+    hsv_image = HSVImage(width, height, rng, pool=pool, render=False, tolerance=tolerance)
+    # Saved images have always shown [0, 2] x [0, 2], unlike the [-1, 1] previews.
+    hsv_image.generate((0, 2), (0, 2))
 
-    final_image = PILImage.merge("HSV", bands).convert("RGB")
+    final_image = hsv_image.image()
     final_image.save(name + ".png", "PNG")
+    if values:
+        hsv_image.save_values(name + ".npy", x_range=(0, 2), y_range=(0, 2))
+
+
+def stream_HSV(width, height, name, rng=None, pool=None, values=False, tolerance=None, strip_rows=None):
+    """
+    Saves the same image as save_HSV, but renders and writes it a strip of rows
+    at a time, so memory stays proportional to one strip for any size.
+    :param values: Whether to also save the raw values, written a strip at a time too.
+    :param tolerance: The tolerance to sample the trees adaptively with, if any.
+    :param strip_rows: The rows in each strip, see Stream.strips.
+    """
+    hsv_image = HSVImage(width, height, rng, pool=pool, render=False, tolerance=tolerance)
+    hsv_image.stream(name + ".png", (0, 2), (0, 2), name + ".npy" if values else None, strip_rows)
 
 
 if __name__ == "__main__":
+    if "-cache" in argv:
+        environ["RENDER_CACHE"] = argv[argv.index("-cache") + 1]
     if "-gui" in argv:
         root = Tk()
         gui = GUI(root)
@@ -432,7 +428,19 @@ if __name__ == "__main__":
             width = int(argv[argv.index("-width") + 1])
         if "-height" in argv:
             height = int(argv[argv.index("-height") + 1])
-        if "-name" in argv:
-            name = argv[argv.index("-name") + 1]
-            seed(name)
-        save_HSV(width, height, name)
+        save = stream_HSV if "-stream" in argv else save_HSV
+        if "-values" in argv:
+            save = partial(save, values=True)
+        if "-tolerance" in argv:
+            save = partial(save, tolerance=float(argv[argv.index("-tolerance") + 1]))
+        names = seed_names(argv)
+        if names:
+            processes = None
+            if "-processes" in argv:
+                processes = int(argv[argv.index("-processes") + 1])
+            run_batch(save, width, height, names, processes=processes)
+        else:
+            if "-name" in argv:
+                name = argv[argv.index("-name") + 1]
+                seed(name)
+            save(width, height, name)
@@ -1,86 +1,196 @@
+from Batch import *
+from Channels import *
 from Functions import *
+from Render import *
+from Scheduler import *
+from Stream import *
 from PIL import Image as PILImage
 from PIL import ImageTk
+from functools import partial
+from os import environ
 from random import randint
 from random import seed
 from sys import argv
 from tkinter import *
 
+# The most values stream_palette sorts to find the breakpoints.
+BREAKPOINT_SAMPLES = 1 << 20
+
+
+def percentiles(values, samples=None):
+    """
+    The 101 percentiles of the values the breakpoints are read from, where
+    percentile i is the value at index int((n - 1) * i / 100) once sorted.
+    The values are sorted once as a copy, which NumPy does faster than it
+    partitions around 101 indexes or builds a histogram to select from.
+    :param values: The values, which are left as they are.
+    :param samples: If given and fewer than the values, the percentiles are
+                    only approximated from that many evenly spaced values.
+    :return: An array of the 101 percentiles, lowest first.
+    """
+    values = np.ravel(values)
+    if samples is not None and samples < len(values):
+        values = values[::-(-len(values) // samples)]
+    values = np.sort(values)
+    return values[[int((len(values) - 1) * i / 100) for i in range(101)]]
+
+
+def color_values(values, percentiles, colors, breakpoints, width, height):
+    """
+    Colors values by which of the breakpoints they fall between.
+    :param values: The width * height values.
+    :param percentiles: The 101 percentiles of the values, as a list or a
+                        dict by percentile, like PaletteImage's breakpoints.
+    :param colors: The five (r, g, b) colors, from the lowest values up.
+    :param breakpoints: The four percentiles where each color gives way to the next.
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :return: The RGB PIL Image.
+    """
+    thresholds = [percentiles[b] for b in breakpoints]
+    data = np.searchsorted(thresholds, values, side="right")
+    pixels = np.asarray(colors, np.uint8)[data]
+    return PILImage.frombuffer("RGB", (width, height), pixels.tobytes(), "raw", "RGB", 0, 1)
+
 
 class PaletteImage:
-    def __init__(self, width, height):
+    def __init__(self, width, height, rng=None, lut=False, pool=None, render=True, tolerance=None, samples=None,
+                 tree=None):
+        self.rng = make_rng(rng)
         self.width = width
         self.height = height
+        self.lut = lut
+        self.pool = pool
+        self.tolerance = tolerance
+        self.samples = samples
         self.palette = {
-            "tree": FunctionNode(0.8),
+            "tree": FunctionNode(0.8, rng=self.rng) if tree is None else tree,
             "values": [],
             "breakpoints": {},
             "domain": []
         }
-        self.generate()
-        self.generate_breakpoints()
+        if render:
+            self.generate()
+            self.generate_breakpoints()
 
     def generate(self):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.palette["tree"].eval(adjusted_x, adjusted_y))
+        xs, ys = pixel_grid(self.width, self.height)
+        values, = render_values((self.palette["tree"],), xs, ys, self.lut, self.pool, self.tolerance)
         self.palette["values"] = values
-        self.palette["domain"] = [min(values), max(values)]
 
     def generate_breakpoints(self):
-        sorted_values = self.palette["values"].copy()
-        sorted_values.sort()
-
-        for i in range(0, 101):
-            self.palette["breakpoints"][i] = sorted_values[int((len(sorted_values) - 1) * i / 100)]
+        """
+        Sets the breakpoints to the percentiles of the values, and the domain
+        to the lowest and highest of them. With samples set, both are only
+        approximated from that many values, see percentiles.
+        """
+        breakpoints = percentiles(self.palette["values"], self.samples)
+        self.palette["breakpoints"].update(enumerate(breakpoints))
+        self.palette["domain"] = [breakpoints[0], breakpoints[100]]
 
     def new(self, complexity=0.8):
-        self.palette["tree"] = FunctionNode(complexity)
+        self.palette["tree"] = FunctionNode(complexity, rng=self.rng)
         self.generate()
         self.generate_breakpoints()
 
+    def image(self, colors, breakpoints=(20, 40, 60, 80)):
+        """
+        Makes the image of the values, without fuzzing the breakpoints.
+        :param colors: The five (r, g, b) colors, from the lowest values up.
+        :param breakpoints: The four percentiles where each color gives way to the next.
+        :return: The RGB PIL Image.
+        """
+        return color_values(self.palette["values"], self.palette["breakpoints"], colors, breakpoints,
+                            self.width, self.height)
+
+    def save_values(self, file_name, **attributes):
+        """Saves the raw values of the palette to a .npy file, see Channels.save_channels."""
+        palette = {"tree": self.palette["tree"], "values": self.palette["values"]}
+        save_channels(file_name, {"palette": palette}, self.width, self.height, lut=self.lut, **attributes)
+
+    @classmethod
+    def load_values(cls, file_name, rng=None, pool=None):
+        """
+        Rebuilds an image from save_values without evaluating its tree. The
+        values are memory-mapped, and only read to find the breakpoints.
+        """
+        metadata, channels = load_channels(file_name)
+        palette_image = cls.__new__(cls)
+        palette_image.rng = make_rng(rng)
+        palette_image.width, palette_image.height = metadata["width"], metadata["height"]
+        palette_image.lut = metadata["lut"]
+        palette_image.pool = pool
+        palette_image.tolerance = None
+        palette_image.samples = None
+        palette_image.palette = {
+            "tree": channels["palette"]["tree"],
+            "values": channels["palette"]["values"],
+            "breakpoints": {},
+            "domain": []
+        }
+        palette_image.generate_breakpoints()
+        return palette_image
+
 
 class GUI:
     class Preview:
         def __init__(self, master):
             self.master = master
             self.frame = Frame(self.master)
-            self.palette_image = PaletteImage(600, 400)
+            self.palette_image = PaletteImage(600, 400, lut=True, render=False)
             self.pil_image = PILImage.new("RGB", (600, 400))
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
             self.colors = [(0, 0, 0), (64, 64, 64), (128, 128, 128), (192, 192, 192), (255, 255, 255)]
-            self.data = []
             self.breakpoints = []
+            self.scheduler = RenderScheduler(self.master)
+            self.refine("new", new=False)
 
-        def update_breakpoints(self):
-            data = []
-            for v in self.palette_image.palette["values"]:
-                if v < self.palette_image.palette["breakpoints"][self.breakpoints[0]]:
-                    data.append(0)
-                elif v < self.palette_image.palette["breakpoints"][self.breakpoints[1]]:
-                    data.append(1)
-                elif v < self.palette_image.palette["breakpoints"][self.breakpoints[2]]:
-                    data.append(2)
-                elif v < self.palette_image.palette["breakpoints"][self.breakpoints[3]]:
-                    data.append(3)
-                else:
-                    data.append(4)
-            self.data = data
+        def draw(self):
+            return self.palette_image.image(self.colors, self.breakpoints)
 
-        def update_image(self):
-            self.update_breakpoints()
-            data = [self.colors[i] for i in self.data]
-            self.pil_image.putdata(data)
+        def show(self, pil_image):
+            self.pil_image = pil_image
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label.destroy()
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
 
+        def update_image(self):
+            self.show(self.draw())
+
+        def render(self, key, *steps, delay=0):
+            """Runs the steps off the Tk thread, then shows the new preview."""
+            def work(cancelled):
+                for step in steps:
+                    if cancelled():
+                        return None
+                    step()
+                return self.draw()
+            self.scheduler.submit(key, work, self.show, delay)
+
+        def refine(self, key, new=True):
+            """
+            Renders the tree coarse to fine off the Tk thread, showing the preview
+            after every pass, the first at an eighth of the size, with breakpoints
+            from that pass's values. With new, it gets a new tree first. The tree,
+            values and breakpoints are only kept once the last, exact pass is done.
+            """
+            def work(cancelled, report):
+                palette = self.palette_image.palette
+                tree = FunctionNode(0.8, rng=self.palette_image.rng) if new else palette["tree"]
+                for values in progressive_values(tree, 600, 400, lut=self.palette_image.lut, pool=self.palette_image.pool):
+                    if cancelled():
+                        return None
+                    # The colors are not set until the GUI has set up its sliders.
+                    if self.breakpoints:
+                        report(color_values(values, percentiles(values), self.colors, self.breakpoints, 600, 400))
+                palette.update(tree=tree, values=values)
+                self.palette_image.generate_breakpoints()
+
+            self.scheduler.submit(key, work, progress=self.show)
+
     def __init__(self, master):
         self.master = master
         self.frame = Frame(self.master)
@@ -175,85 +285,132 @@ class GUI:
         self.colors[2]["range"].configure(from_=self.colors[1]["range"].get(), to_=self.colors[3]["range"].get())
         self.colors[3]["range"].configure(from_=self.colors[2]["range"].get(), to_=100)
 
+        colors = list(self.preview.colors)
         for i in range(len(self.colors)):
             try:
                 c = (int(self.colors[i]["r"].get()), int(self.colors[i]["g"].get()), int(self.colors[i]["b"].get()))
-                self.preview.colors[i] = c
+                colors[i] = c
                 self.colors[i]["swatch"].configure(bg="#%02x%02x%02x" % c)
             except TclError:
                 pass
+        breakpoints = [self.colors[i]["range"].get() for i in range(4)]
 
-        self.preview.breakpoints = [self.colors[i]["range"].get() for i in range(4)]
-        self.preview.update_image()
+        def set_colors():
+            self.preview.colors = colors
+            self.preview.breakpoints = breakpoints
+
+        self.preview.render("colors", set_colors, delay=SLIDER_DELAY)
 
     def new(self):
-        self.preview.palette_image.new()
-        self.preview.update_breakpoints()
-        self.preview.update_image()
+        self.preview.refine("new")
 
     def save(self):
-        palette_image = PaletteImage(1200, 800)
-        palette_image.palette["tree"] = self.preview.palette_image.palette["tree"]
-        palette_image.generate()
-        palette_image.generate_breakpoints()
-        data = []
-        for v in palette_image.palette["values"]:
-            if v < palette_image.palette["breakpoints"][self.preview.breakpoints[0]]:
-                data.append(0)
-            elif v < palette_image.palette["breakpoints"][self.preview.breakpoints[1]]:
-                data.append(1)
-            elif v < palette_image.palette["breakpoints"][self.preview.breakpoints[2]]:
-                data.append(2)
-            elif v < palette_image.palette["breakpoints"][self.preview.breakpoints[3]]:
-                data.append(3)
-            else:
-                data.append(4)
-        new_data = [self.preview.colors[i] for i in data]
-        final_image = PILImage.new("RGB", (1200, 800))
-        final_image.putdata(new_data)
-        final_image.save(self.save_name.get() + ".png", "PNG")
+        name = self.save_name.get()
+
+        def work(cancelled):
+            colors, breakpoints = self.preview.colors, self.preview.breakpoints
+            # Given the preview's tree, no new one is drawn from the shared rng.
+            palette_image = PaletteImage(1200, 800, tree=self.preview.palette_image.palette["tree"])
+            final_image = palette_image.image(colors, breakpoints)
+            final_image.save(name + ".png", "PNG")
+
+        self.preview.scheduler.submit(("save", name), work)
 
 
-def save_palette(width, height, name, fuzzy):
-    palette_image = PaletteImage(width, height)
+def save_palette(width, height, name, fuzzy, rng=None, pool=None, values=False, tolerance=None, samples=None):
+    palette_image = PaletteImage(width, height, rng, pool=pool, tolerance=tolerance, samples=samples)
+    rng = palette_image.rng
     breakpoints = [20, 40, 60, 80]
     data = []
     if fuzzy:
         for v in palette_image.palette["values"]:
-            if v < palette_image.palette["breakpoints"][breakpoints[0] + randint(-5, 5)]:
+            if v < palette_image.palette["breakpoints"][breakpoints[0] + rng.randint(-5, 5)]:
                 data.append(0)
-            elif v < palette_image.palette["breakpoints"][breakpoints[1] + randint(-5, 5)]:
+            elif v < palette_image.palette["breakpoints"][breakpoints[1] + rng.randint(-5, 5)]:
                 data.append(1)
-            elif v < palette_image.palette["breakpoints"][breakpoints[2] + randint(-5, 5)]:
+            elif v < palette_image.palette["breakpoints"][breakpoints[2] + rng.randint(-5, 5)]:
                 data.append(2)
-            elif v < palette_image.palette["breakpoints"][breakpoints[3] + randint(-5, 5)]:
+            elif v < palette_image.palette["breakpoints"][breakpoints[3] + rng.randint(-5, 5)]:
                 data.append(3)
             else:
                 data.append(4)
+    colors = [(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))]
+    if fuzzy:
+        new_data = [colors[i] for i in data]
+        final_image = PILImage.new("RGB", (width, height))
+        final_image.putdata(new_data)
     else:
-        for v in palette_image.palette["values"]:
-            if v < palette_image.palette["breakpoints"][breakpoints[0]]:
-                data.append(0)
-            elif v < palette_image.palette["breakpoints"][breakpoints[1]]:
-                data.append(1)
-            elif v < palette_image.palette["breakpoints"][breakpoints[2]]:
-                data.append(2)
-            elif v < palette_image.palette["breakpoints"][breakpoints[3]]:
-                data.append(3)
-            else:
-                data.append(4)
-    colors = [(randint(0, 255), randint(0, 255), randint(0, 255)),
-              (randint(0, 255), randint(0, 255), randint(0, 255)),
-              (randint(0, 255), randint(0, 255), randint(0, 255)),
-              (randint(0, 255), randint(0, 255), randint(0, 255)),
-              (randint(0, 255), randint(0, 255), randint(0, 255))]
-    new_data = [colors[i] for i in data]
-    final_image = PILImage.new("RGB", (width, height))
-    final_image.putdata(new_data)
+        final_image = palette_image.image(colors, breakpoints)
     final_image.save(name + ".png", "PNG")
+    if values:
+        palette_image.save_values(name + ".npy")
+
+
+def stream_palette(width, height, name, fuzzy, rng=None, pool=None, values=False, tolerance=None, samples=None,
+                   strip_rows=None):
+    """
+    Saves an image like save_palette, but renders and writes it a strip of
+    rows at a time, so memory stays proportional to one strip for any size.
+    The breakpoints come from at most samples, by default BREAKPOINT_SAMPLES,
+    evenly spaced pixels. Images with no more pixels than that, up to about
+    1000x1000 by default, are instead rendered whole once, and both the
+    breakpoints and the strips are read from those values, which makes the
+    same image as save_palette. Fuzzy images draw their offsets from a
+    NumPy generator seeded by rng, so they differ from save_palette's.
+    :param values: Whether to also save the raw values, written a strip at a time too.
+    :param tolerance: The tolerance to sample the tree adaptively with, if any.
+    :param samples: The most pixels to find the breakpoints from.
+    :param strip_rows: The rows in each strip, see Stream.strips.
+    """
+    palette_image = PaletteImage(width, height, rng, pool=pool, render=False)
+    rng = palette_image.rng
+    pool = pool or default_pool()
+    tree = palette_image.palette["tree"]
+    xs, ys = pixel_grid(width, height)
+    step = max(1, int(np.ceil(np.sqrt(width * height / (samples or BREAKPOINT_SAMPLES)))))
+    if step > 1:
+        sample, = pool.render((tree,), xs[:, ::step], ys[::step])
+        rendered = None
+    else:
+        # Sampling every pixel would render the whole image twice.
+        sample, = render_values((tree,), xs, ys, pool=pool, tolerance=tolerance)
+        rendered = sample
+    breakpoints = percentiles(sample)
+    colors = np.array([(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+                       (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+                       (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+                       (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)),
+                       (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))], np.uint8)
+    offsets = np.random.default_rng(rng.randint(0, 2 ** 32)) if fuzzy else None
+    levels = np.array([[20], [40], [60], [80]])
+    raw = channel_file(name + ".npy", 1, width, height) if values else None
+    with PNGWriter(name + ".png", width, height) as png:
+        for start, stop in strips(width, height, strip_rows):
+            if rendered is None:
+                strip, = render_values((tree,), xs, ys[start:stop], pool=pool, tolerance=tolerance)
+            else:
+                strip = rendered[start * width:stop * width]
+            if fuzzy:
+                thresholds = breakpoints[levels + offsets.integers(-5, 6, (4, len(strip)))]
+            else:
+                thresholds = breakpoints[levels]
+            below = strip < thresholds
+            data = np.where(below.any(axis=0), below.argmax(axis=0), 4)
+            png.write(colors[data])
+            if raw is not None:
+                raw[0, start:stop] = strip.reshape(stop - start, width)
+    if raw is not None:
+        raw.flush()
+        save_channel_metadata(name + ".npy", {"palette": {"tree": tree}}, width, height, lut=False)
 
 
 if __name__ == "__main__":
+    if "-cache" in argv:
+        environ["RENDER_CACHE"] = argv[argv.index("-cache") + 1]
     if "-gui" in argv:
         root = Tk()
         gui = GUI(root)
@@ -267,7 +424,21 @@ if __name__ == "__main__":
             width = int(argv[argv.index("-width") + 1])
         if "-height" in argv:
             height = int(argv[argv.index("-height") + 1])
-        if "-name" in argv:
-            name = argv[argv.index("-name") + 1]
-            seed(name)
-        save_palette(width, height, name, fuzzy)
+        save = stream_palette if "-stream" in argv else save_palette
+        if "-values" in argv:
+            save = partial(save, values=True)
+        if "-tolerance" in argv:
+            save = partial(save, tolerance=float(argv[argv.index("-tolerance") + 1]))
+        if "-samples" in argv:
+            save = partial(save, samples=int(argv[argv.index("-samples") + 1]))
+        names = seed_names(argv)
+        if names:
+            processes = None
+            if "-processes" in argv:
+                processes = int(argv[argv.index("-processes") + 1])
+            run_batch(save, width, height, names, fuzzy, processes=processes)
+        else:
+            if "-name" in argv:
+                name = argv[argv.index("-name") + 1]
+                seed(name)
+            save(width, height, name, fuzzy)
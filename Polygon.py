@@ -1,205 +1,52 @@
 import imageio
 import math
-import multiprocessing
+import numpy as np
 
+from Channels import *
 from Functions import *
+from Render import *
+from Scheduler import *
+from copy import copy
 from os import remove
 from PIL import Image as PILImage
 from PIL import ImageDraw
 from PIL import ImageTk
-from random import randint
+from functools import partial
 from random import seed
 from sys import argv
 from tkinter import *
 
 
-class PolygonImage:
-    def __init__(self, width, height):
-        self.width = width
-        self.height = height
-        self.polygon = {
-            "sides": 6,
-            "angles": [math.pi * randint(0, 359) / 180, math.pi * randint(0, 359) / 180,
-                       math.pi * randint(0, 359) / 180, math.pi * randint(0, 359) / 180,
-                       math.pi * randint(0, 359) / 180, math.pi * randint(0, 359) / 180],
-            "distances": [randint(1, 100) / 100, randint(1, 100) / 100, randint(1, 100) / 100,
-                          randint(1, 100) / 100, randint(1, 100) / 100, randint(1, 100) / 100]
-        }
-        self.polygon["angles"].sort()
-        self.hue = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.sat = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.val = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.opac = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.rot = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 359),
-            "range": randint(1, 360)
-        }
-        self.size = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(5, 50),
-            "range": randint(5, 50)
-        }
+class PolygonImage(ChannelImage):
+    CHANNELS = (("hue", (0, 255), (1, 256)),
+                ("sat", (0, 255), (1, 256)),
+                ("val", (0, 255), (1, 256)),
+                ("opac", (0, 255), (1, 256)),
+                ("rot", (0, 359), (1, 360)),
+                ("size", (5, 50), (5, 50)))
+
+    def __init__(self, width, height, rng=None, lut=False, pool=None, render=True, tolerance=None):
+        self.rng = make_rng(rng)
+        self.new_polygon()
         self.step_size = 5
-        self.generate()
-
-    def generate(self):
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-
-        jobs = []
-        for func in (self._generate_hues, self._generate_sats, self._generate_vals, self._generate_opacs,
-                     self._generate_rots, self._generate_sizes):
-            p = multiprocessing.Process(target=func, args=(return_dict,))
-            jobs.append(p)
-            p.start()
-        for proc in jobs:
-            proc.join()
-
-        self.hue["values"] = return_dict["hue"]
-        self.sat["values"] = return_dict["sat"]
-        self.val["values"] = return_dict["val"]
-        self.opac["values"] = return_dict["opac"]
-        self.rot["values"] = return_dict["rot"]
-        self.size["values"] = return_dict["size"]
+        super().__init__(width, height, self.rng, lut, pool, render, tolerance)
 
     def new_polygon(self):
         self.polygon = {
             "sides": 6,
-            "angles": [math.pi * randint(0, 359) / 180, math.pi * randint(0, 359) / 180,
-                       math.pi * randint(0, 359) / 180, math.pi * randint(0, 359) / 180,
-                       math.pi * randint(0, 359) / 180, math.pi * randint(0, 359) / 180],
-            "distances": [randint(1, 100) / 100, randint(1, 100) / 100, randint(1, 100) / 100,
-                          randint(1, 100) / 100, randint(1, 100) / 100, randint(1, 100) / 100]
+            "angles": [math.pi * self.rng.randint(0, 359) / 180, math.pi * self.rng.randint(0, 359) / 180,
+                       math.pi * self.rng.randint(0, 359) / 180, math.pi * self.rng.randint(0, 359) / 180,
+                       math.pi * self.rng.randint(0, 359) / 180, math.pi * self.rng.randint(0, 359) / 180],
+            "distances": [self.rng.randint(1, 100) / 100, self.rng.randint(1, 100) / 100, self.rng.randint(1, 100) / 100,
+                          self.rng.randint(1, 100) / 100, self.rng.randint(1, 100) / 100, self.rng.randint(1, 100) / 100]
         }
         self.polygon["angles"].sort()
 
-    def _generate_hues(self, return_dict=None):
-        values = []
-        for y in range(-self.step_size, self.height + self.step_size, self.step_size):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.hue["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["hue"] = values
-        else:
-            self.hue["values"] = values
-
-    def _generate_sats(self, return_dict=None):
-        values = []
-        for y in range(-self.step_size, self.height + self.step_size, self.step_size):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.sat["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["sat"] = values
-        else:
-            self.sat["values"] = values
-
-    def _generate_vals(self, return_dict=None):
-        values = []
-        for y in range(-self.step_size, self.height + self.step_size, self.step_size):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.val["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["val"] = values
-        else:
-            self.val["values"] = values
-
-    def _generate_opacs(self, return_dict=None):
-        values = []
-        for y in range(-self.step_size, self.height + self.step_size, self.step_size):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.opac["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["opac"] = values
-        else:
-            self.opac["values"] = values
-
-    def _generate_rots(self, return_dict=None):
-        values = []
-        for y in range(-self.step_size, self.height + self.step_size, self.step_size):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.rot["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["rot"] = values
-        else:
-            self.rot["values"] = values
-
-    def _generate_sizes(self, return_dict=None):
-        values = []
-        for y in range(-self.step_size, self.height + self.step_size, self.step_size):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.size["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["size"] = values
-        else:
-            self.size["values"] = values
-
-    def _new_hue(self, complexity=0.6):
-        self.hue["tree"] = FunctionNode(complexity)
-        self._generate_hues()
-
-    def _new_sat(self, complexity=0.6):
-        self.sat["tree"] = FunctionNode(complexity)
-        self._generate_sats()
-
-    def _new_val(self, complexity=0.6):
-        self.val["tree"] = FunctionNode(complexity)
-        self._generate_vals()
-
-    def _new_opac(self, complexity=0.6):
-        self.opac["tree"] = FunctionNode(complexity)
-        self._generate_opacs()
-
-    def _new_rot(self, complexity=0.6):
-        self.rot["tree"] = FunctionNode(complexity)
-        self._generate_rots()
-
-    def _new_size(self, complexity=0.6):
-        self.size["tree"] = FunctionNode(complexity)
-        self._generate_sizes()
-
-    def new(self, complexity=(0.6, 0.6, 0.6, 0.6, 0.6, 0.6)):
-        self.hue["tree"] = FunctionNode(complexity[0])
-        self.sat["tree"] = FunctionNode(complexity[1])
-        self.val["tree"] = FunctionNode(complexity[2])
-        self.opac["tree"] = FunctionNode(complexity[3])
-        self.rot["tree"] = FunctionNode(complexity[4])
-        self.size["tree"] = FunctionNode(complexity[5])
-        self.generate()
+    def grid(self, x_range=(-1, 1), y_range=(-1, 1)):
+        # Polygons are drawn along rows step_size apart, from a row above the image to one below it.
+        xs, _ = pixel_grid(self.width, self.height, x_range, y_range)
+        ys = map_to(np.arange(-self.step_size, self.height + self.step_size, self.step_size), 0, self.height, *y_range)
+        return xs, ys[:, np.newaxis]
 
 
 class GUI:
@@ -207,27 +54,49 @@ class GUI:
         def __init__(self, master):
             self.master = master
             self.frame = Frame(self.master)
-            self.poly_image = PolygonImage(600, 400)
+            self.poly_image = PolygonImage(600, 400, lut=True, render=False)
             self.pil_image = PILImage.new("RGB", (600, 400))
-            self.draw = ImageDraw.Draw(self.pil_image, "RGBA")
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
+            self.scheduler = RenderScheduler(self.master)
+            self.render("new", self.poly_image.generate)
 
-        def update(self):
-            self.draw.rectangle([0, 0, 600, 400], fill=(255, 255, 255))
+        def paint(self, cancelled=None, poly_image=None):
+            poly_image = poly_image or self.poly_image
+            pil_image = PILImage.new("RGB", (600, 400))
+            draw = ImageDraw.Draw(pil_image, "RGBA")
+            draw.rectangle([0, 0, 600, 400], fill=(255, 255, 255))
 
             i = 0
-            for y in range(-self.poly_image.step_size, 400 + self.poly_image.step_size, self.poly_image.step_size):
-                for x in range(-self.poly_image.step_size, 600 + self.poly_image.step_size, self.poly_image.step_size):
-                    generate_polygon(self.poly_image, self.draw, x, y, i)
+            for y in range(-poly_image.step_size, 400 + poly_image.step_size, poly_image.step_size):
+                if cancelled is not None and cancelled():
+                    return None
+                for x in range(-poly_image.step_size, 600 + poly_image.step_size, poly_image.step_size):
+                    generate_polygon(poly_image, draw, x, y, i)
                     i += 1
+            return pil_image
 
+        def show(self, pil_image):
+            self.pil_image = pil_image
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label.destroy()
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
 
+        def update(self):
+            self.show(self.paint())
+
+        def render(self, key, *steps, delay=0, done=None):
+            """Runs the steps and paints off the Tk thread, then shows the new preview."""
+            def work(cancelled):
+                for step in steps:
+                    if cancelled():
+                        return None
+                    step()
+                return self.paint(cancelled)
+            self.scheduler.submit(key, work, done or self.show, delay)
+
     def __init__(self, master):
         self.boot = True
         self.master = master
@@ -329,81 +198,95 @@ class GUI:
 
     def update(self, n=None):
         if not self.boot:
-            self.preview.poly_image.hue["range"] = self.hue_range.get()
-            self.preview.poly_image.hue["shift"] = self.hue_shift.get()
-            self.preview.poly_image.sat["range"] = self.sat_range.get()
-            self.preview.poly_image.sat["shift"] = self.sat_shift.get()
-            self.preview.poly_image.val["range"] = self.val_range.get()
-            self.preview.poly_image.val["shift"] = self.val_shift.get()
-            self.preview.poly_image.opac["range"] = self.opac_range.get()
-            self.preview.poly_image.opac["shift"] = self.opac_shift.get()
-            self.preview.poly_image.rot["range"] = self.rot_range.get()
-            self.preview.poly_image.rot["shift"] = self.rot_shift.get()
-            self.preview.poly_image.size["range"] = self.size_range.get()
-            self.preview.poly_image.size["shift"] = self.size_shift.get()
-            self.preview.update()
+            poly_image = self.preview.poly_image
+            settings = (
+                (poly_image.hue, self.hue_range.get(), self.hue_shift.get()),
+                (poly_image.sat, self.sat_range.get(), self.sat_shift.get()),
+                (poly_image.val, self.val_range.get(), self.val_shift.get()),
+                (poly_image.opac, self.opac_range.get(), self.opac_shift.get()),
+                (poly_image.rot, self.rot_range.get(), self.rot_shift.get()),
+                (poly_image.size, self.size_range.get(), self.size_shift.get())
+            )
+
+            def set_channels():
+                for channel, stretch, shift in settings:
+                    channel["range"] = stretch
+                    channel["shift"] = shift
+
+            self.preview.render("channels", set_channels, delay=SLIDER_DELAY)
 
     def update_step_size(self):
         if not self.boot:
             try:
-                self.preview.poly_image.step_size = self.step_size.get()
-                self.preview.poly_image.generate()
-                self.update()
+                step_size = self.step_size.get()
             except TclError:
-                pass
+                return
+
+            def set_step_size():
+                self.preview.poly_image.step_size = step_size
+                self.preview.poly_image.generate()
+
+            self.preview.render("step size", set_step_size)
 
     def new_polygon(self):
-        self.polygon_canvas.destroy()
-        self.polygon_canvas = Canvas(self.master, width=32, height=32)
-        self.polygon_canvas.grid(row=8, column=1)
-        self.preview.poly_image.new_polygon()
-        points = []
-        for i in range(6):
-            x = 16 + 16 * self.preview.poly_image.polygon["distances"][i] * \
-                math.cos(self.preview.poly_image.polygon["angles"][i])
-            y = 16 + 16 * self.preview.poly_image.polygon["distances"][i] * \
-                math.sin(self.preview.poly_image.polygon["angles"][i])
-            points.append((x, y))
-        self.polygon_canvas.create_polygon(points, fill="black")
-        self.preview.update()
+        def done(pil_image):
+            self.polygon_canvas.destroy()
+            self.polygon_canvas = Canvas(self.master, width=32, height=32)
+            self.polygon_canvas.grid(row=8, column=1)
+            points = []
+            for i in range(6):
+                x = 16 + 16 * self.preview.poly_image.polygon["distances"][i] * \
+                    math.cos(self.preview.poly_image.polygon["angles"][i])
+                y = 16 + 16 * self.preview.poly_image.polygon["distances"][i] * \
+                    math.sin(self.preview.poly_image.polygon["angles"][i])
+                points.append((x, y))
+            self.polygon_canvas.create_polygon(points, fill="black")
+            self.preview.show(pil_image)
+
+        self.preview.render("new polygon", self.preview.poly_image.new_polygon, done=done)
 
     def new_hue_tree(self):
-        self.preview.poly_image._new_hue()
-        self.preview.update()
+        self.preview.render("new hue", partial(self.preview.poly_image.new_channel, "hue"))
 
     def new_sat_tree(self):
-        self.preview.poly_image._new_sat()
-        self.preview.update()
+        self.preview.render("new sat", partial(self.preview.poly_image.new_channel, "sat"))
 
     def new_val_tree(self):
-        self.preview.poly_image._new_val()
-        self.preview.update()
+        self.preview.render("new val", partial(self.preview.poly_image.new_channel, "val"))
 
     def new_opac_tree(self):
-        self.preview.poly_image._new_opac()
-        self.preview.update()
+        self.preview.render("new opac", partial(self.preview.poly_image.new_channel, "opac"))
 
     def new_rot_tree(self):
-        self.preview.poly_image._new_rot()
-        self.preview.update()
+        self.preview.render("new rot", partial(self.preview.poly_image.new_channel, "rot"))
 
     def new_size_tree(self):
-        self.preview.poly_image._new_size()
-        self.preview.update()
+        self.preview.render("new size", partial(self.preview.poly_image.new_channel, "size"))
 
     def save(self):
         self.preview.pil_image.save(self.save_name.get() + ".png", "PNG")
 
     def create_gif(self):
-        frames = []
-        for i in range(0, 360):
-            self.preview.poly_image.rot["shift"] = i
-            self.preview.update()
-            self.preview.pil_image.save("{}-{}.png".format(self.save_name.get(), i))
-            frames.append(imageio.imread("{}-{}.png".format(self.save_name.get(), i)))
-        imageio.mimsave('{}.gif'.format(self.save_name.get()), frames, 'GIF', duration=1/60)
-        for i in range(0, 360):
-            remove("{}-{}.png".format(self.save_name.get(), i))
+        name = self.save_name.get()
+        # The frames turn a copy of the channels taken now, so the sliders
+        # can keep changing the preview's own while the GIF renders.
+        poly_image = copy(self.preview.poly_image)
+        for channel in poly_image.channels():
+            setattr(poly_image, channel, dict(getattr(poly_image, channel)))
+
+        def work(cancelled):
+            frames = []
+            for i in range(0, 360):
+                poly_image.rot["shift"] = i
+                pil_image = self.preview.paint(cancelled, poly_image)
+                if pil_image is None:
+                    return None
+                # Kept in memory rather than round tripped through PNG files,
+                # so there is nothing to clean up when it is cancelled.
+                frames.append(np.asarray(pil_image))
+            imageio.mimsave('{}.gif'.format(name), frames, 'GIF', duration=1/60)
+
+        self.preview.scheduler.submit(("gif", name), work)
 
 
 def hsv_to_rgb(h, s, v):
@@ -452,8 +335,8 @@ def generate_polygon(poly_image, draw, x, y, i):
     draw.polygon(points, fill=(red, green, blue, int(opac)))
 
 
-def save_polygon_png(width, height, name):
-    poly_image = PolygonImage(width, height)
+def save_polygon_png(width, height, name, rng=None):
+    poly_image = PolygonImage(width, height, rng)
     pil_image = PILImage.new("RGB", (width, height))
     draw = ImageDraw.Draw(pil_image, "RGBA")
 
@@ -466,8 +349,8 @@ def save_polygon_png(width, height, name):
     pil_image.save(name + ".png", "PNG")
 
 
-def save_polygon_gif(width, height, name):
-    poly_image = PolygonImage(width, height)
+def save_polygon_gif(width, height, name, rng=None):
+    poly_image = PolygonImage(width, height, rng)
     pil_image = PILImage.new("RGB", (width, height))
     draw = ImageDraw.Draw(pil_image, "RGBA")
 
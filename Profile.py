@@ -0,0 +1,155 @@
+import Functions
+import json
+import numpy as np
+
+from Functions import *
+from random import seed
+from sys import argv
+from time import perf_counter
+
+
+class TreeProfile:
+    """
+    Call counts and time spent evaluating each kind of function and each
+    level of the tree (0 being the root), filled in while profiling is on.
+    Times are for the function itself, not the subtrees feeding it.
+    """
+    def __init__(self):
+        self.functions = {}
+        self.levels = {}
+        self._level = 0
+
+    def record(self, name, level, seconds):
+        for table, key in (self.functions, name), (self.levels, level):
+            entry = table.get(key)
+            if entry is None:
+                table[key] = [1, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+
+    @property
+    def seconds(self):
+        return sum(seconds for calls, seconds in self.functions.values())
+
+    def to_dict(self):
+        return {
+            "seconds": self.seconds,
+            "functions": {name: {"calls": calls, "seconds": seconds}
+                          for name, (calls, seconds) in sorted(self.functions.items(), key=lambda item: -item[1][1])},
+            "levels": {str(level): {"calls": calls, "seconds": seconds}
+                       for level, (calls, seconds) in sorted(self.levels.items())}
+        }
+
+    def to_json(self, indent=None):
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def __str__(self):
+        total = self.seconds or 1
+        lines = ["{:<12}{:>10}{:>12}{:>8}".format("function", "calls", "seconds", "%")]
+        for name, entry in self.to_dict()["functions"].items():
+            lines.append("{:<12}{:>10}{:>12.4f}{:>8.1f}".format(
+                name, entry["calls"], entry["seconds"], 100 * entry["seconds"] / total))
+        lines.append("{:<12}{:>10}{:>12}{:>8}".format("level", "calls", "seconds", "%"))
+        for level, entry in self.to_dict()["levels"].items():
+            lines.append("{:<12}{:>10}{:>12.4f}{:>8.1f}".format(
+                level, entry["calls"], entry["seconds"], 100 * entry["seconds"] / total))
+        return "\n".join(lines)
+
+
+class profiling:
+    """
+    Context manager that records every FunctionNode.eval, eval_grid and
+    eval_lut call made inside it into a TreeProfile. The normal methods are
+    swapped back in on exit, so nothing is slowed down when profiling is
+    off. Only this process is profiled; renders that fan out to other
+    processes have to call the per-channel methods directly.
+    """
+    _active = None
+
+    def __init__(self, profile=None):
+        self.profile = TreeProfile() if profile is None else profile
+
+    def __enter__(self):
+        if profiling._active is not None:
+            raise RuntimeError("Profiling is already on")
+        profiling._active = self.profile
+        self._methods = FunctionNode.eval, FunctionNode.eval_grid
+        FunctionNode.eval = _profiled_eval
+        FunctionNode.eval_grid = _profiled_eval_grid
+        return self.profile
+
+    def __exit__(self, *exc_info):
+        FunctionNode.eval, FunctionNode.eval_grid = self._methods
+        profiling._active = None
+        return False
+
+
+def _profiled_eval(self, x, y):
+    profile = profiling._active
+    level = profile._level
+    profile._level = level + 1
+    try:
+        newX = self.left.eval(x, y)
+        newY = self.right.eval(x, y)
+    finally:
+        profile._level = level
+    start = perf_counter()
+    z = self.func.eval(newX, newY)
+    profile.record(type(self.func).__name__, level, perf_counter() - start)
+    return z
+
+
+def _profiled_eval_grid(self, xs, ys, lut=False):
+    profile = profiling._active
+    level = profile._level
+    profile._level = level + 1
+    try:
+        with np.errstate(all='ignore'):
+            if lut:
+                newX = self.left.eval_lut(xs, ys)
+                newY = self.right.eval_lut(xs, ys)
+            else:
+                newX = self.left.eval_grid(xs, ys)
+                newY = self.right.eval_grid(xs, ys)
+    finally:
+        profile._level = level
+    start = perf_counter()
+    with np.errstate(all='ignore'):
+        z = self.func.eval_lut(newX, newY) if lut else self.func.eval_grid(newX, newY)
+    profile.record(type(self.func).__name__, level, perf_counter() - start)
+    return Functions._broadcast_grid(z, xs, ys)
+
+
+def profile_tree(tree, width=300, height=200, lut=False, profile=None):
+    """
+    Profiles evaluating a tree over a width x height image.
+    :param tree: The FunctionNode to evaluate.
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :param lut: Whether to use the lookup tables, as in FunctionNode.eval_grid.
+    :param profile: A TreeProfile to add to, or None for a new one.
+    :return: The TreeProfile.
+    """
+    xs, ys = pixel_grid(width, height)
+    with profiling(profile) as profile:
+        tree.eval_grid(xs, ys, lut)
+    return profile
+
+
+if __name__ == "__main__":
+    count = 20
+    complexity = 0.8
+    if "-count" in argv:
+        count = int(argv[argv.index("-count") + 1])
+    if "-complexity" in argv:
+        complexity = float(argv[argv.index("-complexity") + 1])
+    if "-name" in argv:
+        seed(argv[argv.index("-name") + 1])
+    profile = TreeProfile()
+    for i in range(count):
+        profile_tree(FunctionNode(complexity), lut="-lut" in argv, profile=profile)
+    if "-json" in argv:
+        with open(argv[argv.index("-json") + 1], "w") as f:
+            f.write(profile.to_json(indent=2))
+    print(profile)
@@ -1,107 +1,23 @@
-import multiprocessing
-
+from Batch import *
+from Channels import *
 from Functions import *
+from Render import *
+from Scheduler import *
+from Stream import *
 from PIL import Image as PILImage
 from PIL import ImageTk
-from random import randint
+from functools import partial
+from os import environ
 from random import seed
 from sys import argv
 from tkinter import *
 
 
-class RGBImage:
-    def __init__(self, width, height):
-        self.width = width
-        self.height = height
-        self.red = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.green = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.blue = {
-            "tree": FunctionNode(0.6),
-            "values": [],
-            "shift": randint(0, 255),
-            "range": randint(1, 256)
-        }
-        self.generate()
-
-    def generate(self):
-        manager = multiprocessing.Manager()
-        return_dict = manager.dict()
-
-        jobs = []
-        for func in self._generate_reds, self._generate_greens, self._generate_blues:
-            p = multiprocessing.Process(target=func, args=(return_dict,))
-            jobs.append(p)
-            p.start()
-        for proc in jobs:
-            proc.join()
-
-        self.red["values"] = return_dict["red"]
-        self.green["values"] = return_dict["green"]
-        self.blue["values"] = return_dict["blue"]
-
-    def _generate_reds(self, return_dict=None):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.red["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["red"] = values
-        else:
-            self.red["values"] = values
-
-    def _generate_greens(self, return_dict=None):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.green["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["green"] = values
-        else:
-            self.green["values"] = values
-
-    def _generate_blues(self, return_dict=None):
-        values = []
-        for y in range(self.height):
-            adjusted_y = map_to(y, 0, self.height, -1, 1)
-            for x in range(self.width):
-                adjusted_x = map_to(x, 0, self.width, -1, 1)
-                values.append(self.blue["tree"].eval(adjusted_x, adjusted_y))
-        if return_dict is not None:
-            return_dict["blue"] = values
-        else:
-            self.blue["values"] = values
-
-    def _new_red(self, complexity=0.6):
-        self.red["tree"] = FunctionNode(complexity)
-        self._generate_reds()
-
-    def _new_green(self, complexity=0.6):
-        self.green["tree"] = FunctionNode(complexity)
-        self._generate_greens()
-
-    def _new_blue(self, complexity=0.6):
-        self.blue["tree"] = FunctionNode(complexity)
-        self._generate_blues()
-
-    def new(self, complexity=(0.6, 0.6, 0.6)):
-        self.red["tree"] = FunctionNode(complexity[0])
-        self.green["tree"] = FunctionNode(complexity[1])
-        self.blue["tree"] = FunctionNode(complexity[2])
-        self.generate()
+class RGBImage(ChannelImage):
+    CHANNELS = (("red", (0, 255), (1, 256)),
+                ("green", (0, 255), (1, 256)),
+                ("blue", (0, 255), (1, 256)))
+    MODE = "RGB"
 
 
 class GUI:
@@ -109,64 +25,47 @@ class GUI:
         def __init__(self, master):
             self.master = master
             self.frame = Frame(self.master)
-            self.rgb_image = RGBImage(600, 400)
+            # Rendered exactly, not with the lookup tables, so that saving can
+            # reuse the preview's values as a quarter of the full size grid.
+            self.rgb_image = RGBImage(600, 400, render=False)
             self.pil_image = PILImage.new("RGB", (600, 400))
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
             self.visibilities = [True, True, True]
             self.bands = [PILImage.new("L", (600, 400)), PILImage.new("L", (600, 400)), PILImage.new("L", (600, 400))]
-
-        def _generate_red_band(self, return_dict=None):
-            data = []
-            for i in self.rgb_image.red["values"]:
-                data.append(round(map_to(i, -1, 1, 0, self.rgb_image.red["range"]) + self.rgb_image.red["shift"]) % 256)
-            if return_dict:
-                img = PILImage.new("L", (600, 400))
-                img.putdata(data)
-                return_dict["red_band"] = img
-            else:
-                self.bands[0].putdata(data)
-
-        def _generate_green_band(self, return_dict=None):
-            data = []
-            for i in self.rgb_image.green["values"]:
-                data.append(round(map_to(i, -1, 1, 0, self.rgb_image.green["range"]) + self.rgb_image.green["shift"]
-                                  ) % 256)
-            if return_dict:
-                img = PILImage.new("L", (600, 400))
-                img.putdata(data)
-                return_dict["green_band"] = img
-            else:
-                self.bands[1].putdata(data)
-
-        def _generate_blue_band(self, return_dict=None):
-            data = []
-            for i in self.rgb_image.blue["values"]:
-                data.append(round(map_to(i, -1, 1, 0, self.rgb_image.blue["range"]) + self.rgb_image.blue["shift"]
-                                  ) % 256)
-            if return_dict:
-                img = PILImage.new("L", (600, 400))
-                img.putdata(data)
-                return_dict["blue_band"] = img
-            else:
-                self.bands[2].putdata(data)
+            self.levels = [None, None, None]
+            self.level_values = [None, None, None]
+            self.scheduler = RenderScheduler(self.master)
+            self.full_values = [None, None, None]
+            self.speculated = [None, None, None]
+            self.save_scheduler = RenderScheduler(self.master)
+            self.refine("new", 0, 1, 2, new=False)
+
+        def _levels(self, i, values):
+            # Quantized once for each new tree; the sliders only change the table.
+            if self.level_values[i] is not values:
+                self.level_values[i] = values
+                self.levels[i] = channel_levels(values)
+            return self.levels[i]
+
+        def _generate_red_band(self):
+            red = self.rgb_image.red
+            self.bands[0] = remap_band(self._levels(0, red["values"]), red["shift"], red["range"], 600, 400)
+
+        def _generate_green_band(self):
+            green = self.rgb_image.green
+            self.bands[1] = remap_band(self._levels(1, green["values"]), green["shift"], green["range"], 600, 400)
+
+        def _generate_blue_band(self):
+            blue = self.rgb_image.blue
+            self.bands[2] = remap_band(self._levels(2, blue["values"]), blue["shift"], blue["range"], 600, 400)
 
         def generate(self):
-            manager = multiprocessing.Manager()
-            return_dict = manager.dict()
-
-            jobs = []
             for func in self._generate_red_band, self._generate_green_band, self._generate_blue_band:
-                p = multiprocessing.Process(target=func, args=(return_dict,))
-                jobs.append(p)
-                p.start()
-            for proc in jobs:
-                proc.join()
+                func()
 
-            self.bands = return_dict["red_band"], return_dict["green_band"], return_dict["blue_band"]
-
-        def update(self):
+        def compose(self):
             bands = []
             if self.visibilities[0]:
                 bands.append(self.bands[0])
@@ -180,12 +79,85 @@ class GUI:
                 bands.append(self.bands[2])
             else:
                 bands.append(PILImage.new("L", (600, 400), color=self.rgb_image.blue["shift"]))
-            self.pil_image = PILImage.merge("RGB", bands)
+            return PILImage.merge("RGB", bands)
+
+        def show(self, pil_image):
+            self.pil_image = pil_image
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             self.label.destroy()
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
 
+        def update(self):
+            self.show(self.compose())
+
+        def render(self, key, *steps, delay=0):
+            """Runs the steps off the Tk thread, then shows the new preview."""
+            def work(cancelled):
+                for step in steps:
+                    if cancelled():
+                        return None
+                    step()
+                return self.compose(), [(channel["tree"], channel["values"]) for channel in self.channels()]
+
+            def done(result):
+                pil_image, trees = result
+                self.show(pil_image)
+                self.speculate(trees)
+
+            self.scheduler.submit(key, work, done, delay)
+
+        def refine(self, key, *indexes, new=True):
+            """
+            Renders the channels at the indexes coarse to fine off the Tk thread,
+            showing the preview after every pass, the first at an eighth of the size.
+            With new, they get new trees first.
+            """
+            def work(cancelled, report):
+                channels = [self.channels()[i] for i in indexes]
+                trees = [self.rgb_image.new_tree() if new else channel["tree"] for channel in channels]
+                passes = zip(*[progressive_values(tree, 600, 400, lut=self.rgb_image.lut, pool=self.rgb_image.pool)
+                               for tree in trees])
+                for values in passes:
+                    if cancelled():
+                        return None
+                    for i, channel, channel_values in zip(indexes, channels, values):
+                        self.bands[i] = remap_band(self._levels(i, channel_values), channel["shift"], channel["range"],
+                                                   600, 400)
+                    report(self.compose())
+                for channel, tree, channel_values in zip(channels, trees, values):
+                    channel.update(tree=tree, values=channel_values)
+                return [(channel["tree"], channel["values"]) for channel in self.channels()]
+
+            self.scheduler.submit(key, work, self.speculate, progress=self.show)
+
+        def channels(self):
+            return self.rgb_image.red, self.rgb_image.green, self.rgb_image.blue
+
+        def speculate(self, trees):
+            # Starts rendering each new tree exactly at full size in the background,
+            # see Render.exact_values, so that saving finds them ready.
+            for i, (tree, values) in enumerate(trees):
+                if self.speculated[i] is not tree:
+                    self.speculated[i] = tree
+                    self._speculate(i, tree, values)
+
+        def _speculate(self, i, tree, values):
+            def work(cancelled):
+                return exact_values(tree, values, 1200, 800, self.rgb_image.lut, self.rgb_image.pool)
+
+            def done(full):
+                self.full_values[i] = tree, full
+
+            self.save_scheduler.submit(i, work, done)
+
+        def full_size_values(self, i):
+            """The 1200x800 values of a channel, rendered now unless speculate already has."""
+            tree, values = self.channels()[i]["tree"], self.channels()[i]["values"]
+            if self.full_values[i] is not None and self.full_values[i][0] is tree:
+                return self.full_values[i][1]
+            return exact_values(tree, values, 1200, 800, self.rgb_image.lut, self.rgb_image.pool)
+
     def __init__(self, master):
         self.master = master
         self.frame = Frame(self.master)
@@ -240,37 +212,31 @@ class GUI:
         self.save_button.grid(row=4, column=6)
 
     def update_red(self, n=None):
-        self.preview.rgb_image.red["range"] = self.red_range.get()
-        self.preview.rgb_image.red["shift"] = self.red_shift.get()
-        self.preview._generate_red_band()
-        self.preview.update()
+        red = self.preview.rgb_image.red
+        stretch, shift = self.red_range.get(), self.red_shift.get()
+        self.preview.render("red", lambda: red.update(range=stretch, shift=shift), self.preview._generate_red_band,
+                            delay=SLIDER_DELAY)
 
     def new_red_tree(self):
-        self.preview.rgb_image._new_red()
-        self.preview._generate_red_band()
-        self.preview.update()
+        self.preview.refine("new red", 0)
 
     def update_green(self, n=None):
-        self.preview.rgb_image.green["range"] = self.green_range.get()
-        self.preview.rgb_image.green["shift"] = self.green_shift.get()
-        self.preview._generate_green_band()
-        self.preview.update()
+        green = self.preview.rgb_image.green
+        stretch, shift = self.green_range.get(), self.green_shift.get()
+        self.preview.render("green", lambda: green.update(range=stretch, shift=shift), self.preview._generate_green_band,
+                            delay=SLIDER_DELAY)
 
     def new_green_tree(self):
-        self.preview.rgb_image._new_green()
-        self.preview._generate_green_band()
-        self.preview.update()
+        self.preview.refine("new green", 1)
 
     def update_blue(self, n=None):
-        self.preview.rgb_image.blue["range"] = self.blue_range.get()
-        self.preview.rgb_image.blue["shift"] = self.blue_shift.get()
-        self.preview._generate_blue_band()
-        self.preview.update()
+        blue = self.preview.rgb_image.blue
+        stretch, shift = self.blue_range.get(), self.blue_shift.get()
+        self.preview.render("blue", lambda: blue.update(range=stretch, shift=shift), self.preview._generate_blue_band,
+                            delay=SLIDER_DELAY)
 
     def new_blue_tree(self):
-        self.preview.rgb_image._new_blue()
-        self.preview._generate_blue_band()
-        self.preview.update()
+        self.preview.refine("new blue", 2)
 
     def toggle_red(self):
         self.preview.visibilities[0] = not self.preview.visibilities[0]
@@ -278,7 +244,7 @@ class GUI:
         self.red_visible.destroy()
         self.red_visible = Button(self.master, text=text, command=self.toggle_red)
         self.red_visible.grid(row=1, column=6)
-        self.preview.update()
+        self.preview.render("visibility")
 
     def toggle_green(self):
         self.preview.visibilities[1] = not self.preview.visibilities[1]
@@ -286,7 +252,7 @@ class GUI:
         self.green_visible.destroy()
         self.green_visible = Button(self.master, text=text, command=self.toggle_green)
         self.green_visible.grid(row=2, column=6)
-        self.preview.update()
+        self.preview.render("visibility")
 
     def toggle_blue(self):
         self.preview.visibilities[2] = not self.preview.visibilities[2]
@@ -294,42 +260,53 @@ class GUI:
         self.blue_visible.destroy()
         self.blue_visible = Button(self.master, text=text, command=self.toggle_blue)
         self.blue_visible.grid(row=3, column=6)
-        self.preview.update()
+        self.preview.render("visibility")
 
     def save(self):
-        visibility = self.preview.visibilities
-        color = self.preview.rgb_image.red, self.preview.rgb_image.green, self.preview.rgb_image.blue
-        bands = [generate_band(1200, 800, visibility[i], color[i]["tree"], color[i]["shift"], color[i]["range"]) for i in range(3)]
-
-        final_image = PILImage.merge("RGB", bands)
-        final_image.save(self.save_name.get() + ".png", "PNG")
-
-
-def generate_band(width, height, visible, head, shift, stretch):
-    if visible:
-        band = PILImage.new("L", (width, height))
-        data = []
-        for y in range(height):
-            adjusted_y = 2 * y / height
-            for x in range(width):
-                adjusted_x = 2 * x / width
-                data.append(((head.eval(adjusted_x, adjusted_y) / 2 + 0.5) * stretch + shift) % 256)
-        band.putdata(data)
-    else:
-        band = PILImage.new("L", (width, height), color=shift)
-    return band
+        visibility = list(self.preview.visibilities)
+        name = self.save_name.get()
 
+        def work(cancelled):
+            bands = []
+            for i, channel in enumerate(self.preview.channels()):
+                if visibility[i]:
+                    values = self.preview.full_size_values(i)
+                    bands.append(value_band(values, 1200, 800, channel["shift"], channel["range"]))
+                else:
+                    bands.append(PILImage.new("L", (1200, 800), color=channel["shift"]))
 
-def save_RGB(width, height, name):
-    rgb_image = RGBImage(width, height)
-    color = rgb_image.red, rgb_image.green, rgb_image.blue
-    bands = [generate_band(width, height, True, color[i]["tree"], color[i]["shift"], color[i]["range"]) for i in range(3)]
+            final_image = PILImage.merge("RGB", bands)
+            final_image.save(name + ".png", "PNG")
 
-    final_image = PILImage.merge("RGB", bands)
+        self.preview.scheduler.submit(("save", name), work)
+
+
+def save_RGB(width, height, name, rng=None, pool=None, values=False, tolerance=None):
+    rgb_image = RGBImage(width, height, rng, pool=pool, render=False, tolerance=tolerance)
+    # Saved images have always shown [0, 2] x [0, 2], unlike the [-1, 1] previews.
+    rgb_image.generate((0, 2), (0, 2))
+
+    final_image = rgb_image.image()
     final_image.save(name + ".png", "PNG")
+    if values:
+        rgb_image.save_values(name + ".npy", x_range=(0, 2), y_range=(0, 2))
+
+
+def stream_RGB(width, height, name, rng=None, pool=None, values=False, tolerance=None, strip_rows=None):
+    """
+    Saves the same image as save_RGB, but renders and writes it a strip of rows
+    at a time, so memory stays proportional to one strip for any size.
+    :param values: Whether to also save the raw values, written a strip at a time too.
+    :param tolerance: The tolerance to sample the trees adaptively with, if any.
+    :param strip_rows: The rows in each strip, see Stream.strips.
+    """
+    rgb_image = RGBImage(width, height, rng, pool=pool, render=False, tolerance=tolerance)
+    rgb_image.stream(name + ".png", (0, 2), (0, 2), name + ".npy" if values else None, strip_rows)
 
 
 if __name__ == "__main__":
+    if "-cache" in argv:
+        environ["RENDER_CACHE"] = argv[argv.index("-cache") + 1]
     if "-gui" in argv:
         root = Tk()
         gui = GUI(root)
@@ -342,7 +319,19 @@ if __name__ == "__main__":
             width = int(argv[argv.index("-width") + 1])
         if "-height" in argv:
             height = int(argv[argv.index("-height") + 1])
-        if "-name" in argv:
-            name = argv[argv.index("-name") + 1]
-            seed(name)
-        save_RGB(width, height, name)
+        save = stream_RGB if "-stream" in argv else save_RGB
+        if "-values" in argv:
+            save = partial(save, values=True)
+        if "-tolerance" in argv:
+            save = partial(save, tolerance=float(argv[argv.index("-tolerance") + 1]))
+        names = seed_names(argv)
+        if names:
+            processes = None
+            if "-processes" in argv:
+                processes = int(argv[argv.index("-processes") + 1])
+            run_batch(save, width, height, names, processes=processes)
+        else:
+            if "-name" in argv:
+                name = argv[argv.index("-name") + 1]
+                seed(name)
+            save(width, height, name)
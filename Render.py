@@ -0,0 +1,471 @@
+import atexit
+import multiprocessing
+import numpy as np
+import os
+import threading
+
+from Cache import default_cache
+from Functions import FunctionNode
+from Functions import TreeArrays
+from Functions import map_to
+from Functions import pixel_grid
+from functools import lru_cache
+from multiprocessing import shared_memory
+from PIL import Image as PILImage
+
+# The number of levels channel values are quantized to for the previews.
+CHANNEL_LEVELS = 65536
+# How many times coarser than the preview the first pass of a progressive render is.
+PREVIEW_FACTOR = 8
+# The size of the coarsest cells adaptive_values samples, in pixels.
+ADAPTIVE_BLOCK = 16
+# The error adaptive_values allows by default: half a level of a band with a range of 256.
+ADAPTIVE_TOLERANCE = 1 / 256
+
+
+class SharedChannels:
+    """
+    One flat float array per channel, each in its own block of shared
+    memory owned by the parent process. Workers store whole channels with
+    channels[name] = values, or strips of rows with write, straight into the
+    parent's memory instead of pickling them back. The parent then takes
+    each channel out, which frees its block. Use it as a context manager so
+    any blocks left are released.
+    """
+    def __init__(self, names, size, memory_names=None):
+        self.size = size
+        if memory_names is None:
+            self.memory = {name: shared_memory.SharedMemory(create=True, size=max(1, 8 * size)) for name in names}
+        else:
+            self.memory = {name: shared_memory.SharedMemory(memory_name)
+                           for name, memory_name in zip(names, memory_names)}
+
+    def _array(self, name):
+        return np.ndarray((self.size,), np.float64, self.memory[name].buf)
+
+    def __setitem__(self, name, values):
+        self._array(name)[:] = np.ravel(values)
+
+    def write(self, name, offset, values):
+        """Stores values in a channel from the offset on, as a strip of rows."""
+        values = np.ravel(values)
+        self._array(name)[offset:offset + values.size] = values
+
+    def take(self, name):
+        """Returns a copy of the channel and frees its shared memory."""
+        values = self._array(name).copy()
+        memory = self.memory.pop(name)
+        memory.close()
+        memory.unlink()
+        return values
+
+    def __reduce__(self):
+        # Processes that are spawned rather than forked attach by name.
+        names = tuple(self.memory)
+        return SharedChannels, (names, self.size, tuple(self.memory[name].name for name in names))
+
+    def detach(self):
+        """Lets go of the blocks in a worker, leaving them to the parent."""
+        for memory in self.memory.values():
+            memory.close()
+        self.memory = {}
+
+    def close(self):
+        for name in list(self.memory):
+            memory = self.memory.pop(name)
+            memory.close()
+            memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def band_image(levels, width, height):
+    """
+    Makes an "L" image straight from the buffer of an array of levels, with
+    no list of pixels in between.
+    :param levels: The width * height levels, in [0, 256). Fractions are
+                   dropped, as Image.putdata does.
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :return: The PIL Image.
+    """
+    levels = np.ascontiguousarray(np.clip(levels, 0, 255), dtype=np.uint8)
+    return PILImage.frombuffer("L", (width, height), levels, "raw", "L", 0, 1)
+
+
+def channel_levels(values):
+    """
+    Quantizes channel values once to 16 bits, so a change of shift or range
+    is only a remap_band of the levels and never goes back to the values.
+    :param values: The values, in [-1, 1].
+    :return: A uint16 array of levels.
+    """
+    return np.round((np.clip(values, -1, 1) + 1) * ((CHANNEL_LEVELS - 1) / 2)).astype(np.uint16)
+
+
+@lru_cache(maxsize=64)
+def band_lut(shift, stretch):
+    """
+    The table taking each level of channel_levels to its band level,
+    round(map_to(value, -1, 1, 0, stretch) + shift) % 256.
+    :param shift: The shift of the channel.
+    :param stretch: The range of the channel.
+    :return: A read-only uint8 array of CHANNEL_LEVELS band levels.
+    """
+    values = np.linspace(-1, 1, CHANNEL_LEVELS)
+    lut = (np.round(map_to(values, -1, 1, 0, stretch) + shift) % 256).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def value_band(values, width, height, shift, stretch):
+    """
+    Makes an "L" band from channel values as the full size saves do,
+    ((value / 2 + 0.5) * stretch + shift) % 256 with the fraction dropped.
+    :param values: The width * height values, in [-1, 1].
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :param shift: The shift of the channel.
+    :param stretch: The range of the channel.
+    :return: The PIL Image.
+    """
+    return band_image(((np.asarray(values) / 2 + 0.5) * stretch + shift) % 256, width, height)
+
+
+def remap_band(levels, shift, stretch, width, height):
+    """
+    Makes an "L" band from channel_levels with a single table lookup.
+    :param levels: The width * height levels from channel_levels.
+    :param shift: The shift of the channel.
+    :param stretch: The range of the channel.
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :return: The PIL Image.
+    """
+    data = np.take(band_lut(shift, stretch), levels)
+    return PILImage.frombuffer("L", (width, height), data, "raw", "L", 0, 1)
+
+
+class RenderPool:
+    """
+    Renders trees over a pixel grid in strips of rows, farmed out to a pool
+    of worker processes that is started on first use and kept for every
+    render after, so each render only pays for sending the trees (as their
+    binary genomes). The workers write their strips straight into
+    SharedChannels, so no values are pickled back. With one process or fewer
+    everything is rendered in this process instead. Given a RenderCache,
+    trees whose values over the grid are cached are not evaluated at all,
+    and the rest are first folded down with simplify_tree.
+    """
+    def __init__(self, processes=None, strip_rows=None, cache=None):
+        """
+        :param processes: The number of worker processes, by default one per
+                          available core.
+        :param strip_rows: The number of rows in each strip, by default
+                           enough for about four strips per process.
+        :param cache: The RenderCache to keep the values in, if any.
+        """
+        if processes is None:
+            processes = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        self.processes = processes
+        self.strip_rows = strip_rows
+        self.cache = cache
+        self._pool = None
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+            atexit.register(self.close)
+        return self._pool
+
+    def render(self, trees, xs, ys, lut=False, cache=True):
+        """
+        Evaluates every tree at every point of the grid.
+        :param trees: The FunctionNodes to evaluate.
+        :param xs: A row of x coordinates, as returned by pixel_grid.
+        :param ys: A column of y coordinates, as returned by pixel_grid.
+        :param lut: Whether to use the lookup tables, as in FunctionNode.eval_grid.
+        :param cache: Whether to use the pool's cache, if it has one. Partial
+                      renders that will not be asked for again, as the passes
+                      of refine_values and adaptive_values, leave it out.
+        :return: A list with the flat array of values of each tree.
+        """
+        if self.cache is None or not cache:
+            return self._render(trees, xs, ys, lut)
+        keys = [self.cache.key(tree, xs, ys, lut) for tree in trees]
+        channels = [self.cache.get(key) for key in keys]
+        missing = [i for i, values in enumerate(channels) if values is None]
+        if missing:
+            for i, values in zip(missing, self._render([trees[i] for i in missing], xs, ys, lut)):
+                self.cache.put(keys[i], values)
+                channels[i] = values
+        return channels
+
+    def _render(self, trees, xs, ys, lut):
+        trees = [simplify_tree(tree, xs, ys) for tree in trees]
+        if self.processes <= 1:
+            return [tree.eval_grid(xs, ys, lut).ravel() for tree in trees]
+        height = np.shape(ys)[0]
+        rows = self.strip_rows or max(1, -(-height * len(trees) // (4 * self.processes)))
+        width = np.shape(xs)[-1]
+        # TreeArrays rather than to_bytes, since a flat tree is a bare Constant.
+        genomes = [TreeArrays.from_tree(tree).to_bytes() for tree in trees]
+        with SharedChannels(range(len(trees)), height * width) as channels:
+            tasks = [(i, start * width, genome, xs, ys[start:start + rows], lut, channels)
+                     for i, genome in enumerate(genomes) for start in range(0, height, rows)]
+            for done in self.pool().imap_unordered(_render_strip, tasks):
+                pass
+            return [channels.take(i) for i in range(len(trees))]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+# Trees a worker has already rebuilt, by genome, since every strip of a
+# render carries the same few trees.
+_strip_trees = {}
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def _render_strip(task):
+    i, offset, genome, xs, ys, lut, channels = task
+    tree = _strip_trees.get(genome)
+    if tree is None:
+        if len(_strip_trees) >= 64:
+            _strip_trees.clear()
+        tree = _strip_trees[genome] = FunctionNode.from_bytes(genome)
+    try:
+        channels.write(i, offset, tree.eval_grid(xs, ys, lut))
+    finally:
+        channels.detach()
+    return i, offset
+
+
+def simplify_tree(tree, xs, ys):
+    """
+    Folds away every part of a tree that makes no difference over a grid:
+    FunctionNode.simplify with a tolerance of 0 over the span of the
+    coordinates, so the tree renders exactly the same values with fewer
+    nodes. A tree that is flat over the whole grid becomes a Constant.
+    :param tree: The FunctionNode.
+    :param xs: The x coordinates of the grid.
+    :param ys: The y coordinates of the grid.
+    :return: The simplified tree.
+    """
+    if not np.size(xs) or not np.size(ys):
+        return tree
+    return tree.simplify(0.0, (np.min(xs), np.max(xs)), (np.min(ys), np.max(ys)))
+
+
+def default_pool():
+    """
+    Returns the RenderPool shared by every image that is not given its own,
+    which caches its renders if Cache.default_cache is set up.
+    """
+    global _default_pool
+    # The GUIs' workers can ask for it at the same time as the Tk thread, and
+    # each pool it would make twice starts its own worker processes.
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = RenderPool(cache=default_cache())
+    return _default_pool
+
+
+def refine_values(tree, coarse, width, height, lut=False, pool=None):
+    """
+    Evaluates a tree over the width x height pixel_grid, reusing its values
+    over a coarser pixel_grid whose sides divide these by the same factor.
+    Every point of the coarse grid is then exactly a point of the fine one,
+    so only the rest are evaluated: three quarters of them at double size.
+    :param tree: The FunctionNode.
+    :param coarse: The flat values of the tree over the coarse grid.
+    :param width: The width of the fine grid, in pixels.
+    :param height: The height of the fine grid, in pixels.
+    :param lut: Whether to use the lookup tables, as the coarse values did.
+    :param pool: The RenderPool to render with, by default default_pool().
+    :return: The flat array of width * height values.
+    """
+    factor = int(round((width * height / np.size(coarse)) ** 0.5))
+    if factor < 1 or width % factor or height % factor or (width // factor) * (height // factor) != np.size(coarse):
+        raise ValueError("A {}x{} grid does not contain a grid of {} values".format(width, height, np.size(coarse)))
+    pool = pool or default_pool()
+    xs, ys = pixel_grid(width, height)
+    values = np.empty((height, width))
+    values[::factor, ::factor] = np.reshape(coarse, (height // factor, width // factor))
+    if factor > 1:
+        columns = np.arange(width) % factor != 0
+        rows = np.arange(height) % factor != 0
+        row_values, = pool.render((tree,), xs[:, columns], ys[::factor], lut, cache=False)
+        values[::factor, columns] = row_values.reshape(height // factor, -1)
+        rest, = pool.render((tree,), xs, ys[rows], lut, cache=False)
+        values[rows] = rest.reshape(-1, width)
+    return values.ravel()
+
+
+def exact_values(tree, preview, width, height, preview_lut=False, pool=None):
+    """
+    The exact values of a tree over the width x height pixel_grid, as saved
+    images need. The values of a preview are reused with refine_values, but
+    only if they are exact themselves: values from the lookup tables are
+    approximate, so then the whole grid is rendered without them.
+    :param tree: The FunctionNode.
+    :param preview: The flat values of the tree over the preview's grid.
+    :param width: The width of the grid, in pixels.
+    :param height: The height of the grid, in pixels.
+    :param preview_lut: Whether the preview values came from the lookup tables.
+    :param pool: The RenderPool to render with, by default default_pool().
+    :return: The flat array of width * height values.
+    """
+    if preview_lut:
+        xs, ys = pixel_grid(width, height)
+        values, = (pool or default_pool()).render((tree,), xs, ys)
+        return values
+    return refine_values(tree, preview, width, height, pool=pool)
+
+
+def expand_values(values, factor, width, height):
+    """
+    Blows the values over a grid factor times coarser than width x height
+    up to width * height, repeating each over its factor x factor block.
+    :return: The flat array of width * height values.
+    """
+    blocks = np.reshape(values, (height // factor, width // factor))
+    return np.repeat(np.repeat(blocks, factor, axis=0), factor, axis=1).ravel()
+
+
+def progressive_values(tree, width, height, factor=PREVIEW_FACTOR, lut=False, pool=None):
+    """
+    Renders a tree over the width x height pixel_grid coarse to fine. The
+    first pass is over a grid factor times coarser, and every pass after
+    doubles the size with refine_values, so no point is evaluated twice and
+    the whole costs about the same as rendering at full size.
+    :param tree: The FunctionNode.
+    :param width: The width of the grid, in pixels.
+    :param height: The height of the grid, in pixels.
+    :param factor: How many times coarser the first pass is, a power of two.
+                   It is halved until it divides both sides.
+    :param lut: Whether to use the lookup tables.
+    :param pool: The RenderPool to render with, by default default_pool().
+    :return: A generator of the values of each pass, blown up to width *
+             height with expand_values, ending with the exact values.
+    """
+    while factor > 1 and (width % factor or height % factor):
+        factor //= 2
+    pool = pool or default_pool()
+    xs, ys = pixel_grid(width // factor, height // factor)
+    values, = pool.render((tree,), xs, ys, lut, cache=factor == 1)
+    while factor > 1:
+        yield expand_values(values, factor, width, height)
+        factor //= 2
+        values = refine_values(tree, values, width // factor, height // factor, lut, pool)
+    yield values
+
+
+def adaptive_values(tree, xs, ys, tolerance=ADAPTIVE_TOLERANCE, lut=False, pool=None, block=ADAPTIVE_BLOCK):
+    """
+    Evaluates a tree over a grid like RenderPool.render, but only where it
+    is not smooth. The tree is first evaluated at the corners of block x
+    block cells. Each cell is then split into four, evaluating the five
+    points that adds, and a cell whose new points are all within tolerance
+    of what bilinear interpolation of its corners predicted is filled in
+    by interpolating its quarters. The rest are split again until every
+    pixel is evaluated. Smooth stretches of a tree cost a handful of
+    evaluations per cell, while edges, ripples and checkers are still
+    evaluated at every pixel. A feature that fits between the samples of
+    the coarsest cells entirely can be missed, so block trades speed for safety.
+    :param tree: The FunctionNode.
+    :param xs: A row of x coordinates, as returned by pixel_grid.
+    :param ys: A column of y coordinates, as returned by pixel_grid.
+    :param tolerance: The largest interpolation error allowed. A band with a
+                      range of r changes a level every 2 / r.
+    :param lut: Whether to use the lookup tables, as in FunctionNode.eval_grid.
+    :param pool: The RenderPool to render with, by default default_pool().
+    :param block: The size of the coarsest cells, a power of two.
+    :return: The flat array of values.
+    """
+    pool = pool or default_pool()
+    width, height = np.size(xs), np.size(ys)
+    # The lattice of cells runs past the last row and column, where the coordinates carry on evenly.
+    columns = -(-max(width - 1, 1) // block)
+    rows = -(-max(height - 1, 1) // block)
+    grid_xs = _extend(xs, columns * block + 1)
+    grid_ys = _extend(ys, rows * block + 1)
+    values = np.zeros((rows * block + 1, columns * block + 1))
+    known = np.zeros(values.shape, bool)
+    corners, = pool.render((tree,), grid_xs[np.newaxis, ::block], grid_ys[::block, np.newaxis], lut, cache=False)
+    values[::block, ::block] = corners.reshape(rows + 1, columns + 1)
+    known[::block, ::block] = True
+    active = np.ones((rows, columns), bool)
+    step = block
+    while step > 1 and active.any():
+        half = step // 2
+        children = np.repeat(np.repeat(active, 2, axis=0), 2, axis=1)
+        needed = np.zeros((2 * rows + 1, 2 * columns + 1), bool)
+        for r in 0, 1:
+            for c in 0, 1:
+                needed[r:r + 2 * rows, c:c + 2 * columns] |= children
+        needed[::2, ::2] = False
+        point_rows, point_columns = np.nonzero(needed)
+        points, = pool.render((tree,), grid_xs[np.newaxis, point_columns * half],
+                              grid_ys[np.newaxis, point_rows * half], lut, cache=False)
+        values[point_rows * half, point_columns * half] = points
+        known[point_rows * half, point_columns * half] = True
+        lattice = values[::half, ::half]
+        top_left, top_right = lattice[:-1:2, :-1:2], lattice[:-1:2, 2::2]
+        bottom_left, bottom_right = lattice[2::2, :-1:2], lattice[2::2, 2::2]
+        with np.errstate(invalid="ignore", over="ignore"):
+            error = np.maximum.reduce([
+                abs(lattice[:-1:2, 1::2] - (top_left + top_right) / 2),
+                abs(lattice[2::2, 1::2] - (bottom_left + bottom_right) / 2),
+                abs(lattice[1::2, :-1:2] - (top_left + bottom_left) / 2),
+                abs(lattice[1::2, 2::2] - (top_right + bottom_right) / 2),
+                abs(lattice[1::2, 1::2] - (top_left + top_right + bottom_left + bottom_right) / 4)])
+            flat = active & (error <= tolerance)
+        active = np.repeat(np.repeat(active & ~flat, 2, axis=0), 2, axis=1)
+        rows, columns, step = 2 * rows, 2 * columns, half
+    _interpolate(values, known, block)
+    return values[:height, :width].ravel()
+
+
+def render_values(trees, xs, ys, lut=False, pool=None, tolerance=None):
+    """
+    Evaluates every tree at every point of the grid, exactly with
+    RenderPool.render, or with adaptive_values given a tolerance.
+    :return: A list with the flat array of values of each tree.
+    """
+    pool = pool or default_pool()
+    if tolerance is None:
+        return pool.render(trees, xs, ys, lut)
+    return [adaptive_values(tree, xs, ys, tolerance, lut, pool) for tree in trees]
+
+
+def _extend(coordinates, size):
+    coordinates = np.ravel(coordinates)
+    if len(coordinates) >= size:
+        return coordinates[:size]
+    spacing = coordinates[-1] - coordinates[-2] if len(coordinates) > 1 else 0
+    return np.concatenate((coordinates, coordinates[-1] + spacing * np.arange(1, size - len(coordinates) + 1)))
+
+
+def _interpolate(values, known, block):
+    # Fills in every point that was not evaluated from the coarsest cells
+    # down, each from the midpoint of its neighbours a level up, which for a
+    # cell whose edges were not evaluated either is bilinear interpolation.
+    step = block
+    while step > 1:
+        half = step // 2
+        lattice, missing = values[::half, ::half], ~known[::half, ::half]
+        np.copyto(lattice[::2, 1::2], (lattice[::2, :-1:2] + lattice[::2, 2::2]) / 2, where=missing[::2, 1::2])
+        np.copyto(lattice[1::2, ::2], (lattice[:-1:2, ::2] + lattice[2::2, ::2]) / 2, where=missing[1::2, ::2])
+        centers = (lattice[:-1:2, :-1:2] + lattice[:-1:2, 2::2] + lattice[2::2, :-1:2] + lattice[2::2, 2::2]) / 4
+        np.copyto(lattice[1::2, 1::2], centers, where=missing[1::2, 1::2])
+        step = half
@@ -0,0 +1,127 @@
+import queue
+import threading
+
+from collections import OrderedDict
+
+# How long, in milliseconds, slider renders wait for the slider to settle.
+SLIDER_DELAY = 40
+
+
+class RenderScheduler:
+    """
+    Runs a GUI's renders one at a time on a background thread, so the Tk
+    event loop keeps running while trees are evaluated and drawn.
+
+    Every render is submitted under a key. A newer render under the same key
+    replaces one still waiting to run and tells one already running to stop,
+    so a burst of slider events costs one render instead of a queue of them.
+    Given a delay, a render first waits that many milliseconds for a newer
+    one under its key before it is queued at all. The result of each render
+    that was not superseded is handed to its done callback on the Tk thread,
+    which is the only thread that may touch widgets.
+    """
+    def __init__(self, master, poll=10):
+        """
+        :param master: The Tk widget whose event loop delivers the results.
+        :param poll: How often, in milliseconds, to check for finished renders.
+        """
+        self.master = master
+        self.poll = poll
+        self._waiting = {}
+        self._queued = OrderedDict()
+        self._running = None
+        self._finished = queue.Queue()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._polling = None
+
+    def submit(self, key, work, done=None, delay=0, progress=None):
+        """
+        Schedules a render. Call this from the Tk thread.
+        :param key: Renders under the same key supersede each other.
+        :param work: Called on the background thread with a function that
+                     returns True once the render has been superseded, which
+                     long renders should check to stop early.
+        :param done: Called on the Tk thread with what work returned.
+        :param delay: Milliseconds to wait for a newer render first.
+        :param progress: If given, work is also passed a function to report
+                         partial results with, as the passes of a progressive
+                         render. Each is handed to progress on the Tk thread,
+                         unless the render has been superseded by then.
+        :return: None
+        """
+        waiting = self._waiting.pop(key, None)
+        if waiting is not None:
+            self.master.after_cancel(waiting)
+        job = _Job(work, done, progress)
+        if delay:
+            self._waiting[key] = self.master.after(delay, self._queue, key, job)
+        else:
+            self._queue(key, job)
+
+    def busy(self):
+        with self._condition:
+            running = bool(self._queued) or self._running is not None
+        return running or bool(self._waiting) or not self._finished.empty()
+
+    def _queue(self, key, job):
+        self._waiting.pop(key, None)
+        with self._condition:
+            self._queued.pop(key, None)
+            if self._running is not None and self._running[0] == key:
+                self._running[1].cancel()
+            self._queued[key] = job
+            self._condition.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if self._polling is None:
+            self._polling = self.master.after(self.poll, self._poll)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queued:
+                    self._condition.wait()
+                self._running = self._queued.popitem(last=False)
+            job = self._running[1]
+            try:
+                if job.progress is None:
+                    result = job.work(job.cancelled)
+                else:
+                    result = job.work(job.cancelled, lambda partial: self._finished.put((job, partial, None, job.progress)))
+                self._finished.put((job, result, None, job.done))
+            except Exception as e:
+                self._finished.put((job, None, e, None))
+            with self._condition:
+                self._running = None
+
+    def _poll(self):
+        self._polling = self.master.after(self.poll, self._poll) if self.busy() else None
+        while True:
+            try:
+                job, result, error, callback = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            if job.cancelled():
+                continue
+            if error is not None:
+                raise error
+            if callback is not None:
+                callback(result)
+
+
+class _Job:
+    __slots__ = ("work", "done", "progress", "_cancelled")
+
+    def __init__(self, work, done, progress=None):
+        self.work = work
+        self.done = done
+        self.progress = progress
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
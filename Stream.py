@@ -0,0 +1,89 @@
+import numpy as np
+import struct
+import zlib
+
+# The number of pixels in a strip by default, about 32MB for each channel of values.
+STRIP_PIXELS = 1 << 22
+
+
+class PNGWriter:
+    """
+    Writes an 8-bit RGB PNG a strip of rows at a time, compressing each
+    strip as it arrives, so the whole image is never held in memory. Rows
+    are written with the PNG "Up" filter, which only needs the last row of
+    the strip before. Use it as a context manager to finish the file.
+    """
+    def __init__(self, file_name, width, height, level=6):
+        """
+        :param file_name: The name of the file to write.
+        :param width: The width of the image, in pixels.
+        :param height: The height of the image, in pixels.
+        :param level: The zlib compression level.
+        """
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self._previous = np.zeros(3 * width, np.uint8)
+        self._compressor = zlib.compressobj(level)
+        self.file = open(file_name, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write(self, rows):
+        """
+        Adds the next rows to the image.
+        :param rows: An RGB PIL Image or uint8 array, as wide as the image.
+        :return: None
+        """
+        rows = np.asarray(rows, np.uint8).reshape(-1, 3 * self.width)
+        if self.rows + len(rows) > self.height:
+            raise ValueError("More than {} rows written".format(self.height))
+        filtered = np.empty((len(rows), 3 * self.width + 1), np.uint8)
+        filtered[:, 0] = 2
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        np.subtract(rows[:1], self._previous, out=filtered[:1, 1:])
+        self._previous = rows[-1].copy()
+        self.rows += len(rows)
+        compressed = self._compressor.compress(filtered)
+        if compressed:
+            self._chunk(b"IDAT", compressed)
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            if self.rows != self.height:
+                raise ValueError("{} of {} rows written".format(self.rows, self.height))
+            self._chunk(b"IDAT", self._compressor.flush())
+            self._chunk(b"IEND", b"")
+        finally:
+            self.file.close()
+
+    def _chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+        return False
+
+
+def strips(width, height, strip_rows=None):
+    """
+    Splits the rows of an image into strips.
+    :param width: The width of the image, in pixels.
+    :param height: The height of the image, in pixels.
+    :param strip_rows: The rows in each strip, by default enough for about
+                       STRIP_PIXELS pixels.
+    :return: A generator of the (start, stop) rows of each strip.
+    """
+    rows = strip_rows or max(1, STRIP_PIXELS // width)
+    for start in range(0, height, rows):
+        yield start, min(height, start + rows)
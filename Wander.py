@@ -1,6 +1,7 @@
 import imageio
 import math
 import multiprocessing
+import numpy as np
 
 from Functions import *
 from os import remove
@@ -11,17 +12,20 @@ from random import seed
 
 class FieldImage:
     class Field:
-        def __init__(self, width, height, node_step, force):
-            tree = FunctionNode(0.99)
+        def __init__(self, width, height, node_step, force, rng=None):
+            tree = FunctionNode(0.99, rng=rng)
             self.nodes = {}
             self.node_step = node_step
             self.force = force
             self.width, self.height = width, height
-            for y in range(-height // (8 * self.node_step) * self.node_step, 9 * height // 8, self.node_step):
-                adjusted_y = map_to(y, -height // (8 * self.node_step) * self.node_step, 9 * height // 8, -1, 1)
-                for x in range(-width // (8 * self.node_step) * self.node_step, 9 * width // 8, self.node_step):
-                    adjusted_x = map_to(x, -width // (8 * self.node_step) * self.node_step, 9 * width // 8, -1, 1)
-                    self.nodes[(x, y)] = map_to(tree.eval(adjusted_x, adjusted_y), -1, 1, 0, 2 * math.pi)
+            ys = range(-height // (8 * self.node_step) * self.node_step, 9 * height // 8, self.node_step)
+            xs = range(-width // (8 * self.node_step) * self.node_step, 9 * width // 8, self.node_step)
+            adjusted_y = map_to(np.array(ys), ys.start, ys.stop, -1, 1)
+            adjusted_x = map_to(np.array(xs), xs.start, xs.stop, -1, 1)
+            angles = map_to(tree.eval_grid(adjusted_x[np.newaxis, :], adjusted_y[:, np.newaxis]), -1, 1, 0, 2 * math.pi)
+            for j, y in enumerate(ys):
+                for i, x in enumerate(xs):
+                    self.nodes[(x, y)] = angles[j, i]
 
         def _determine_effectors(self, pos):
             x, y = pos
@@ -50,9 +54,12 @@ class FieldImage:
                 force[1] += yf
             return force
 
-    def __init__(self, width, height, name, time_step, force):
-        self.field = self.Field(width, height, 5, force)
-        self.color_tree = (FunctionNode(0.8), FunctionNode(0.8), FunctionNode(0.8))
+    def __init__(self, width, height, name, time_step, force, rng=None):
+        self.rng = make_rng(rng)
+        self.field = self.Field(width, height, 5, force, self.rng)
+        self.color_tree = (FunctionNode(0.8, rng=self.rng), FunctionNode(0.8, rng=self.rng), FunctionNode(0.8, rng=self.rng))
+        # Every pen looks up its color one point at a time, so use the flat versions of the trees.
+        self.color_eval = tuple(tree.compile() for tree in self.color_tree)
         self.img = PILImage.new("RGB", (width, height), color=(255, 255, 255))
         self.time_step = time_step
         self.draw = ImageDraw.ImageDraw(self.img, "RGBA")
@@ -124,9 +131,9 @@ class FieldImage:
 
     def new_pen(self, pos):
         color = (
-                    int(map_to(self.color_tree[0].eval(pos[0], pos[1]), -1, 1, 0, 255)),
-                    int(map_to(self.color_tree[1].eval(pos[0], pos[1]), -1, 1, 0, 255)),
-                    int(map_to(self.color_tree[2].eval(pos[0], pos[1]), -1, 1, 0, 255)),
+                    int(map_to(self.color_eval[0](pos[0], pos[1]), -1, 1, 0, 255)),
+                    int(map_to(self.color_eval[1](pos[0], pos[1]), -1, 1, 0, 255)),
+                    int(map_to(self.color_eval[2](pos[0], pos[1]), -1, 1, 0, 255)),
                     2
                 )
         self.pens.append(
@@ -141,13 +148,13 @@ class FieldImage:
         )
 
 
-def save_gif(name):
-    field_img = FieldImage(800, 600, name, 1, 1)
+def save_gif(name, rng=None):
+    field_img = FieldImage(800, 600, name, 1, 1, rng)
     field_img.create_gif()
 
 
-def save_wander(name, width, height, time):
-    field_img = FieldImage(width, height, name, 1, 1)
+def save_wander(name, width, height, time, rng=None):
+    field_img = FieldImage(width, height, name, 1, 1, rng)
     field_img.create_png(200)
 
 
@@ -1,24 +1,27 @@
 import math
 
+from Functions import make_rng
 from PIL import Image as PILImage
 from PIL import ImageDraw
 from PIL import ImageTk
 from random import choice
 from random import randint
 from random import seed
+from Scheduler import RenderScheduler
 from sys import argv
 from tkinter import *
 
 
 class WatercolorImage:
-    def __init__(self, width, height, blobs=None, strokes=None):
+    def __init__(self, width, height, blobs=None, strokes=None, rng=None):
+        self.rng = make_rng(rng)
         self.width = width
         self.height = height
         if strokes:
             self.strokes = strokes
         else:
             self.strokes = {
-                "count": randint(60, 90),
+                "count": self.rng.randint(60, 90),
                 "size": (10, 55),
                 "values": []
             }
@@ -26,7 +29,7 @@ class WatercolorImage:
             self.blobs = blobs
         else:
             self.blobs = {
-                "count": randint(80, 120),
+                "count": self.rng.randint(80, 120),
                 "size": (30, 70),
                 "values": []
             }
@@ -73,12 +76,12 @@ class WatercolorImage:
             return angle
 
         points = []
-        num_points = randint(3, 7)
+        num_points = self.rng.randint(3, 7)
         for i in range(num_points):
-            x = randint(-self.width // 4, self.width * 5 // 4)
-            y = randint(-self.height // 4, self.height * 5 // 4)
+            x = self.rng.randint(-self.width // 4, self.width * 5 // 4)
+            y = self.rng.randint(-self.height // 4, self.height * 5 // 4)
             points.append((x, y))
-        if randint(0, 10) < 5:
+        if self.rng.randint(0, 10) < 5:
             points.sort(key=lambda point: point[0])
         else:
             points.sort(key=lambda point: point[1])
@@ -95,7 +98,7 @@ class WatercolorImage:
             b_curve.append((x, y))
 
         stroke_points = []
-        size = randint(self.strokes["size"][0], self.strokes["size"][1])
+        size = self.rng.randint(self.strokes["size"][0], self.strokes["size"][1])
         # Draw the rounded beginning, starting with the upper perp
         angle = calc_perp(b_curve[0], b_curve[1]) + math.pi
         for i in range(4):
@@ -126,10 +129,10 @@ class WatercolorImage:
 
     def generate_blob(self):
         blob_points = []
-        x, y = randint(0, self.width), randint(0, self.height)
-        size = randint(self.blobs["size"][0], self.blobs["size"][1])
-        angle = randint(0, 359) * math.pi / 180
-        num_points = randint(5, 9)
+        x, y = self.rng.randint(0, self.width), self.rng.randint(0, self.height)
+        size = self.rng.randint(self.blobs["size"][0], self.blobs["size"][1])
+        angle = self.rng.randint(0, 359) * math.pi / 180
+        num_points = self.rng.randint(5, 9)
         for i in range(num_points):
             blob_points.append((x + math.cos(angle) * size, y + math.sin(angle) * size))
             angle += 2 * math.pi / num_points
@@ -142,14 +145,14 @@ class GUI:
             self.master = master
             self.frame = Frame(self.master)
             self.pil_image = PILImage.new("RGB", (600, 400))
-            self.draw = ImageDraw.Draw(self.pil_image, "RGBA")
             self.watercolor = None
             self.colors = None
             self.tk_image = None
             self.label = None
+            self.scheduler = RenderScheduler(self.master)
             self.new()
 
-        def new(self, retain=False):
+        def paint(self, retain=False, cancelled=None):
             if retain:
                 strokes = self.watercolor.strokes
                 blobs = self.watercolor.blobs
@@ -162,17 +165,38 @@ class GUI:
                            (randint(0, 255), randint(0, 255), randint(0, 255), 8),
                            (randint(0, 255), randint(0, 255), randint(0, 255), 8),
                            (randint(0, 255), randint(0, 255), randint(0, 255), 8)]
-            self.draw.rectangle([0, 0, 600, 400], fill="white")
+            pil_image = PILImage.new("RGB", (600, 400))
+            draw = ImageDraw.Draw(pil_image, "RGBA")
+            draw.rectangle([0, 0, 600, 400], fill="white")
             all_polys = self.watercolor.strokes["values"].copy()
             all_polys.extend(self.watercolor.blobs["values"])
             for poly in all_polys:
-                paint_polygon(self.watercolor, poly, choice(self.colors), self.draw)
+                if cancelled is not None and cancelled():
+                    return None
+                paint_polygon(self.watercolor, poly, choice(self.colors), draw)
+            return pil_image
+
+        def show(self, pil_image):
+            self.pil_image = pil_image
             self.tk_image = ImageTk.PhotoImage(image=self.pil_image)
             if self.label:
                 self.label.destroy()
             self.label = Label(self.master, image=self.tk_image)
             self.label.pack()
 
+        def new(self, retain=False):
+            self.show(self.paint(retain))
+
+        def render(self, *steps, retain=False):
+            """Runs the steps and paints off the Tk thread, then shows the new preview."""
+            def work(cancelled):
+                for step in steps:
+                    if cancelled():
+                        return None
+                    step()
+                return self.paint(retain, cancelled)
+            self.scheduler.submit("paint", work, self.show)
+
     def __init__(self, master):
         self.master = master
         self.frame = Frame(self.master)
@@ -204,7 +228,7 @@ class GUI:
         self.blob_max_size.insert(0, str(self.preview.watercolor.blobs["size"][1]))
         self.blob_count.insert(0, str(self.preview.watercolor.blobs["count"]))
 
-        self.new_button = Button(self.master, text="New", command=self.preview.new)
+        self.new_button = Button(self.master, text="New", command=self.new)
         self.new_button.grid(row=3, column=0)
 
         self.update_button = Button(self.master, text="Update", command=self.update)
@@ -216,27 +240,39 @@ class GUI:
         self.save_button = Button(master=self.master, text="Save", command=self.save)
         self.save_button.grid(row=3, column=5)
 
+    def new(self):
+        self.preview.render()
+
     def update(self):
-        self.preview.watercolor.strokes["size"] = (int(self.stroke_min_size.get()), int(self.stroke_max_size.get()))
-        self.preview.watercolor.strokes["count"] = int(self.stroke_count.get())
-        self.preview.watercolor.blobs["size"] = (int(self.blob_min_size.get()), int(self.blob_max_size.get()))
-        self.preview.watercolor.blobs["count"] = int(self.blob_count.get())
-        self.preview.new(True)
+        stroke_size = (int(self.stroke_min_size.get()), int(self.stroke_max_size.get()))
+        stroke_count = int(self.stroke_count.get())
+        blob_size = (int(self.blob_min_size.get()), int(self.blob_max_size.get()))
+        blob_count = int(self.blob_count.get())
+
+        def set_sizes():
+            self.preview.watercolor.strokes["size"] = stroke_size
+            self.preview.watercolor.strokes["count"] = stroke_count
+            self.preview.watercolor.blobs["size"] = blob_size
+            self.preview.watercolor.blobs["count"] = blob_count
+
+        self.preview.render(set_sizes, retain=True)
 
     def save(self):
         self.preview.pil_image.save(self.save_name.get() + ".png", "PNG")
 
 
-def deform_polygon(poly):
+def deform_polygon(poly, rng=None):
+    rng = make_rng(rng)
+
     def rand_point():
         dx = p2[0] - p1[0]
         dy = p2[1] - p1[1]
         try:
-            x = dx / abs(dx) * randint(0, int(abs(dx)))
+            x = dx / abs(dx) * rng.randint(0, int(abs(dx)))
         except ZeroDivisionError:
             x = 0
         try:
-            y = dy / abs(dy) * randint(0, int(abs(dy)))
+            y = dy / abs(dy) * rng.randint(0, int(abs(dy)))
         except ZeroDivisionError:
             y = 0
         return p1[0] + x, p1[1] + y
@@ -255,31 +291,33 @@ def deform_polygon(poly):
 
 
 def paint_polygon(watercolor, polygon, color, draw):
-    for i in range(randint(watercolor.strokes["size"][0] // 20, watercolor.strokes["size"][1] // 12)):
+    rng = watercolor.rng
+    for i in range(rng.randint(watercolor.strokes["size"][0] // 20, watercolor.strokes["size"][1] // 12)):
         poly = polygon
-        for j in range(randint(watercolor.strokes["size"][0] // 11, watercolor.strokes["size"][1] // 9)):
-            poly = deform_polygon(poly)
+        for j in range(rng.randint(watercolor.strokes["size"][0] // 11, watercolor.strokes["size"][1] // 9)):
+            poly = deform_polygon(poly, rng)
         draw.polygon(poly, fill=color)
 
 
-def save_watercolor(name, width, height, blobs, strokes):
+def save_watercolor(name, width, height, blobs, strokes, rng=None):
     if not width or not height:
         width = 1200
         height = 800
     if not name:
         name = "test"
-    watercolor = WatercolorImage(width, height, blobs, strokes)
+    watercolor = WatercolorImage(width, height, blobs, strokes, rng)
+    rng = watercolor.rng
     pil_image = PILImage.new("RGB", (width, height))
     draw = ImageDraw.Draw(pil_image, "RGBA")
-    colors = [(randint(0, 255), randint(0, 255), randint(0, 255), 8),
-              (randint(0, 255), randint(0, 255), randint(0, 255), 8),
-              (randint(0, 255), randint(0, 255), randint(0, 255), 8),
-              (randint(0, 255), randint(0, 255), randint(0, 255), 8)]
+    colors = [(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), 8),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), 8),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), 8),
+              (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255), 8)]
     draw.rectangle([0, 0, width, height], fill="white")
     all_polys = watercolor.strokes["values"].copy()
     all_polys.extend(watercolor.blobs["values"])
     for poly in all_polys:
-        paint_polygon(watercolor, poly, choice(colors), draw)
+        paint_polygon(watercolor, poly, rng.choice(colors), draw)
     pil_image.save(name + ".png", "PNG")
 
 